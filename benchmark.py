@@ -0,0 +1,153 @@
+"""Performance benchmarks for pricing, simulation steps and experiment
+throughput. Every result is seconds per operation (lower is better),
+so runs can be saved as JSON and compared against a baseline:
+
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+"""
+import argparse
+import json
+import marketmaker
+import multiprocessing
+import my_bot
+import numpy
+import other_bots
+import platform
+import prices
+import random
+import re
+import run_experiments
+import simulation
+import sys
+import timeit
+
+def best_time(function, number, repeat=5):
+    """Best time of repeat runs, per call of function."""
+    return min(timeit.repeat(function, number=number,
+                             repeat=repeat)) / number
+
+def bench_pricing(quick=False):
+    number = 2000 if quick else 20000
+    results = {}
+    results['quote.hansonPriceCheck'] = best_time(
+        lambda: marketmaker.hansonPriceCheck('buy', 10, 37.0, 250), number)
+    market = prices.LMSR(250)
+    user = prices.User(0, {})
+    quantities = iter(xrange(sys.maxint))
+    # a new quantity every call, so the quote cache never hits
+    results['quote.lmsr'] = best_time(
+        lambda: prices.check('buy', 1 + next(quantities) * 1e-6, market,
+                             user), number)
+    results['quote.lmsr_cached'] = best_time(
+        lambda: prices.check('buy', 10, market, user), number)
+    amounts = numpy.arange(1, 200)
+    results['quote.check_many_199'] = best_time(
+        lambda: prices.check_many('buy', amounts, market, user),
+        number // 10)
+    sides = iter(xrange(sys.maxint))
+    # alternate buys and sells so the market stays near 50
+    results['execute.prices_execute'] = best_time(
+        lambda: prices.execute(('buy', 'sell')[next(sides) % 2], 10,
+                               market, user), number)
+    return results
+
+def make_bots(traders):
+    """MyBot plus fundamentals and technical traders, 4 to 1."""
+    technical = (traders - 1) // 5
+    return [my_bot.MyBot()] + other_bots.get_bots(
+        traders - 1 - technical, technical)
+
+def bench_steps(trader_counts, quick=False):
+    """Wall time per simulated timestep as the population grows."""
+    simulations = 2 if quick else 5
+    results = {}
+    for traders in trader_counts:
+        def simulate():
+            steps = 0
+            for seed in range(simulations):
+                sim_obj = simulation.Simulation(
+                    100, prices.LMSRFactory(250), make_bots(traders),
+                    log_level='off', seed=seed)
+                sim_obj.simulate()
+                steps += len(sim_obj.p_vec)
+            return steps
+        steps = simulate()
+        results['step.traders_%d' % traders] = best_time(
+            simulate, 1, repeat=3) / steps
+    return results
+
+def bench_throughput(max_processes, quick=False):
+    """Wall time per simulation of run_experiments at 1..max_processes
+    workers, pool start-up included."""
+    simulations = 40 if quick else 200
+    results = {}
+    for processes in range(1, max_processes + 1):
+        def run():
+            run_experiments.experiment(
+                make_bots(11), 100, processes, simulations, 250, 0, 10,
+                None, False, show_progress=False)
+        results['run.processes_%d' % processes] = best_time(
+            run, 1, repeat=1 if quick else 3) / simulations
+    return results
+
+def run_benchmarks(quick=False, trader_counts=(10, 25, 50, 100),
+                   max_processes=None):
+    if max_processes is None:
+        max_processes = multiprocessing.cpu_count()
+    random.seed(0)
+    results = {}
+    results.update(bench_pricing(quick))
+    results.update(bench_steps(trader_counts, quick))
+    results.update(bench_throughput(max_processes, quick))
+    return {'results':results,
+            'meta':{'python':platform.python_version(),
+                    'numpy':numpy.__version__,
+                    'platform':platform.platform(),
+                    'cpus':multiprocessing.cpu_count(),
+                    'quick':quick}}
+
+def report(benchmarks, baseline=None, tolerance=0.1):
+    """Print the results, against the baseline's if given. Returns the
+    names that got slower by more than tolerance."""
+    slower = []
+    def natural(name):
+        return [int(part) if part.isdigit() else part
+                for part in re.split(r'(\d+)', name)]
+    for name in sorted(benchmarks['results'], key=natural):
+        seconds = benchmarks['results'][name]
+        line = '%-28s %12.3f us' % (name, seconds * 1e6)
+        if name.startswith('run.'):
+            line += ' (%1.1f simulations/s)' % (1.0 / seconds)
+        if baseline is not None and name in baseline['results']:
+            ratio = seconds / baseline['results'][name]
+            line += '  %5.2fx baseline' % (ratio,)
+            if ratio > 1 + tolerance:
+                line += '  SLOWER'
+                slower.append(name)
+        print line
+    return slower
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer repetitions, for a rough check')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline results file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative slowdown reported as SLOWER')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='largest worker count for run throughput')
+    args = parser.parse_args(argv)
+    benchmarks = run_benchmarks(args.quick, max_processes=args.processes)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+    slower = report(benchmarks, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(benchmarks, results_file, indent=2, sort_keys=True)
+    return 1 if slower else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
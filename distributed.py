@@ -0,0 +1,269 @@
+"""Simulations on worker processes on any number of hosts. The process
+calling run_distributed serves a Broker with multiprocessing.managers;
+it hands out batches of simulations and collects their results:
+
+    # on the driver, with two local workers
+    distributed.run_distributed(bots, simulations=20000,
+                                address=('', 50000), authkey='secret')
+    # on every other host, with this repository on the path
+    python distributed.py DRIVER_HOST:50000 secret --processes 4
+
+Workers can join at any time. A worker that stops sending heartbeats
+has its batches handed out again.
+"""
+import argparse
+import collections
+import multiprocessing
+import numpy
+import os
+import prices
+import run_experiments
+import socket
+import sys
+import threading
+import time
+from multiprocessing import managers
+
+class Broker(object):
+    '''Hands out the batches [start, stop) of the simulations of one
+    job and collects their results. A batch leased to a worker not heard
+    from for timeout seconds goes back in the queue; if both copies come
+    back, the first is kept.'''
+    def __init__(self, job, simulations, batch_size, timeout):
+        self.job = job
+        self.timeout = timeout
+        self.batches = [(start, min(start + batch_size, simulations))
+                        for start in xrange(0, simulations, batch_size)]
+        self.pending = collections.deque(xrange(len(self.batches)))
+        # batch id -> worker
+        self.leases = {}
+        # batch id -> array of result rows, see run_batch
+        self.results = {}
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def job_info(self):
+        '''The job and how often workers should send heartbeats.'''
+        return self.job, self.timeout / 3.0
+
+    def _seen(self, worker):
+        entry = self.workers.get(worker)
+        if entry is None:
+            entry = self.workers[worker] = {
+                'simulations':0, 'batches':0, 'seconds':0.0,
+                'requeued':0, 'joined':time.time()}
+        entry['seen'] = time.time()
+        return entry
+
+    def _requeue_dead(self):
+        now = time.time()
+        for batch_id, worker in self.leases.items():
+            if now - self.workers[worker]['seen'] > self.timeout:
+                del self.leases[batch_id]
+                self.pending.appendleft(batch_id)
+                self.workers[worker]['requeued'] += 1
+
+    def heartbeat(self, worker):
+        with self.lock:
+            self._seen(worker)
+
+    def get_batch(self, worker):
+        '''(batch id, start, stop) of the next batch, or None if there
+        is none to hand out right now.'''
+        with self.lock:
+            self._seen(worker)
+            self._requeue_dead()
+            while self.pending:
+                batch_id = self.pending.popleft()
+                if batch_id not in self.results:
+                    self.leases[batch_id] = worker
+                    return (batch_id,) + self.batches[batch_id]
+            return None
+
+    def put_result(self, worker, batch_id, rows, seconds):
+        with self.lock:
+            entry = self._seen(worker)
+            entry['batches'] += 1
+            entry['simulations'] += len(rows)
+            entry['seconds'] += seconds
+            if self.leases.get(batch_id) == worker:
+                del self.leases[batch_id]
+            self.results.setdefault(batch_id, rows)
+
+    def finished(self):
+        with self.lock:
+            self._requeue_dead()
+            return len(self.results) == len(self.batches)
+
+    def collect(self):
+        with self.lock:
+            return [self.results[batch_id]
+                    for batch_id in sorted(self.results)]
+
+    def worker_stats(self):
+        with self.lock:
+            return dict((worker, dict(entry))
+                        for worker, entry in self.workers.iteritems())
+
+# The broker lives in the manager's server process. The driver creates
+# it by calling broker(job, ...), workers get it with broker().
+_broker = None
+
+def _get_broker(*args):
+    global _broker
+    if args:
+        _broker = Broker(*args)
+    return _broker
+
+class BrokerManager(managers.BaseManager):
+    pass
+
+BrokerManager.register('broker', callable=_get_broker)
+
+def run_batch(job, start, stop):
+    '''Run simulations start to stop of job. Returns an array with a row
+    (index, market profit, trader profits ordered like trader_names())
+    per simulation, nan profits where it failed.'''
+    timesteps, marketmaker_fact, trader_specs, master, path_bank, width = job
+    rows = numpy.empty((stop - start, width + 1))
+    specs = run_experiments.simulation_specs(
+        stop, timesteps, marketmaker_fact, trader_specs, master, path_bank,
+        start=start)
+    for row, spec in zip(rows, specs):
+        index, market_profit, trader_profits, _ = (
+            run_experiments.worker_process(spec))
+        row[0] = index
+        if market_profit is None:
+            row[1:] = numpy.nan
+        else:
+            row[1] = market_profit
+            row[2:] = trader_profits
+    return rows
+
+def work(address, authkey=None, name=None):
+    '''Run batches from the broker at address until the job is done or
+    the broker goes away.'''
+    if name is None:
+        name = '%s:%d' % (socket.gethostname(), os.getpid())
+    manager = BrokerManager(address, authkey)
+    manager.connect()
+    broker = manager.broker()
+    job, interval = broker.job_info()
+    stopping = threading.Event()
+    def heartbeat():
+        while not stopping.wait(interval):
+            try:
+                broker.heartbeat(name)
+            except (EOFError, IOError):
+                return
+    heartbeat_thread = threading.Thread(target=heartbeat)
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+    try:
+        while True:
+            batch = broker.get_batch(name)
+            if batch is None:
+                if broker.finished():
+                    return
+                time.sleep(min(interval, 1.0))
+                continue
+            batch_id, start, stop = batch
+            began = time.time()
+            rows = run_batch(job, start, stop)
+            broker.put_result(name, batch_id, rows, time.time() - began)
+    except (EOFError, IOError):
+        return
+    finally:
+        stopping.set()
+
+def run_distributed(trader_list, timesteps=100, simulations=2000,
+                    lmsr_b=150, seed=None, batch_size=50,
+                    address=('', 50000), authkey=None, local_workers=2,
+                    timeout=30.0, path_bank=None, keep_profits=False):
+    """Like run_experiments.run, but the simulations are run in batches
+    of batch_size by workers connecting to a broker at address (see
+    work), local_workers of them started here. Remote workers need the
+    same authkey; the default only suits local workers. A path_bank
+    must be at the same path on every host. Results are folded in by
+    simulation index once all are in, so they match run for the same
+    seed whatever the workers. Prints the stats and each worker's
+    throughput, and returns the same as run."""
+    master = run_experiments.master_seed(seed)
+    if path_bank is not None:
+        run_experiments.check_path_bank(path_bank, simulations, timesteps,
+                                        len(trader_list))
+    marketmaker_fact = prices.LMSRFactory(lmsr_b)
+    trader_specs = run_experiments.as_trader_specs(trader_list)
+    market_name = marketmaker_fact.name
+    columns = run_experiments.profit_columns(market_name, trader_specs)
+    job = (timesteps, marketmaker_fact, trader_specs, master, path_bank,
+           len(columns))
+    manager = BrokerManager(address, authkey)
+    manager.start()
+    workers = []
+    try:
+        broker = manager.broker(job, simulations, batch_size, timeout)
+        port = manager.address[1]
+        print >> sys.stderr, 'broker listening on %s:%d' % (
+            socket.gethostname(), port)
+        for _ in range(local_workers):
+            worker = multiprocessing.Process(
+                target=work, args=(('127.0.0.1', port), authkey))
+            worker.start()
+            workers.append(worker)
+        while not broker.finished():
+            time.sleep(0.2)
+        rows = numpy.concatenate(broker.collect())
+        stats_by_worker = broker.worker_stats()
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        manager.shutdown()
+    rows = rows[numpy.argsort(rows[:, 0], kind='mergesort')]
+    stats = run_experiments.new_stats(columns)
+    for row in rows[~numpy.isnan(rows[:, 1])].tolist():
+        run_experiments.fold_profits(stats, columns, row[1], row[2:])
+    results_by_market = {market_name:stats}
+    profits_by_market = None
+    if keep_profits:
+        profits_by_market = {market_name:dict(
+                (name, rows[:, column + 1])
+                for column, name in enumerate(columns))}
+    run_experiments.report(results_by_market)
+    report_workers(stats_by_worker)
+    return results_by_market, profits_by_market
+
+def report_workers(stats_by_worker):
+    print '%-28s %12s %9s %14s %9s' % ('worker', 'simulations', 'batches',
+                                       'simulations/s', 'requeued')
+    for worker, entry in sorted(stats_by_worker.iteritems()):
+        rate = (entry['simulations'] / entry['seconds']
+                if entry['seconds'] > 0 else 0.0)
+        print '%-28s %12d %9d %14.1f %9d' % (
+            worker, entry['simulations'], entry['batches'], rate,
+            entry['requeued'])
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Run simulation batches for a run_distributed broker.')
+    parser.add_argument('address', help='HOST:PORT of the broker')
+    parser.add_argument('authkey')
+    parser.add_argument('--processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='worker processes to run on this host')
+    args = parser.parse_args(argv)
+    host, port = args.address.rsplit(':', 1)
+    workers = [multiprocessing.Process(target=work,
+                                       args=((host, int(port)),
+                                             args.authkey))
+               for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
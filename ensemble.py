@@ -0,0 +1,571 @@
+import numpy
+import information
+import other_bots
+
+# Ensemble mode: N independent markets held as arrays and stepped
+# through each timestep together. Every trader type is one population
+# whose state covers all of its members in all markets; a (member,
+# market) pair is addressed by the flat index member * N + market.
+
+class EnsembleUser(object):
+    def __init__(self, size, cash=0.0, shares=0.0, name=None):
+        self.cash = numpy.empty(size)
+        self.cash.fill(cash)
+        self.shares = numpy.empty(size)
+        self.shares.fill(shares)
+        self.initial_cash = float(cash)
+        self.initial_shares = float(shares)
+        self.name = name
+
+    def profit(self, stock_values):
+        return (stock_values * (self.shares - self.initial_shares)
+                + self.cash - self.initial_cash)
+
+class EnsembleLMSR(object):
+    def __init__(self, max_loss, size, mu=50.0):
+        self.max_loss = float(max_loss)
+        self.quantity_outstanding = numpy.zeros(size)
+        self.mu = numpy.empty(size)
+        self.mu.fill(mu)
+        self.user_account = EnsembleUser(size)
+        self.cancels = 0
+
+    def _cost(self, quantity_outstanding):
+        return self.max_loss * numpy.logaddexp(
+            quantity_outstanding / self.max_loss, 0.0)
+
+    def _path(self, buysell, quantity, markets, repeat):
+        '''Quantities outstanding after 0 .. repeat consecutive orders.'''
+        q = self.quantity_outstanding[markets][:, numpy.newaxis]
+        if buysell == 'sell':
+            quantity = -quantity
+        return q + numpy.reshape(quantity, (-1, 1)) * numpy.arange(repeat + 1)
+
+    def price_check(self, buysell, quantity, markets, repeat=None):
+        '''Per-share price in each of markets. quantity is a scalar, an
+        array aligned with markets, or a (len(markets), k) curve. With
+        repeat, returns the (len(markets), repeat) prices of that many
+        consecutive orders of the same quantity.'''
+        if numpy.ndim(quantity) == 2:
+            q = self.quantity_outstanding[markets][:, numpy.newaxis]
+            if buysell == 'buy':
+                new_q = q + quantity
+            else:
+                new_q = q - quantity
+            total_cost = numpy.abs(self._cost(new_q) - self._cost(q)) * 100
+            return numpy.clip(total_cost / quantity, 0.0, 100.0)
+        path = self._path(buysell, quantity, markets,
+                          1 if repeat is None else repeat)
+        total_cost = numpy.abs(numpy.diff(self._cost(path), axis=1)) * 100
+        per_share = numpy.clip(
+            total_cost / numpy.reshape(quantity, (-1, 1)), 0.0, 100.0)
+        if repeat is None:
+            return per_share[:, 0]
+        return per_share
+
+    def execute(self, buysell, quantity, markets, user, accounts,
+                repeat=None):
+        '''Mirrors prices.execute for every market in markets, repeat
+        times in a row if given, charging user's entries at accounts.
+        Returns the per-share prices shaped like price_check, with nan
+        where an order was cancelled.'''
+        quantity = numpy.broadcast_to(
+            numpy.asarray(quantity, dtype=float), markets.shape)
+        if repeat is None:
+            counts = numpy.ones(len(markets), dtype=int)
+        else:
+            counts = numpy.broadcast_to(repeat, markets.shape)
+        per_share = self.price_check(buysell, quantity, markets,
+                                     repeat=int(counts.max()))
+        if buysell == 'buy':
+            allowed = per_share < 100
+            signed_quantity = quantity
+        else:
+            allowed = 0.01 < per_share
+            signed_quantity = -quantity
+        # Prices are monotone along the path and a cancelled order leaves
+        # the market unchanged, so the filled orders are a prefix.
+        allowed &= (numpy.arange(per_share.shape[1])[numpy.newaxis, :]
+                    < counts[:, numpy.newaxis])
+        filled = numpy.count_nonzero(allowed, axis=1)
+        self.cancels += int(numpy.sum(counts - filled))
+        per_share[~allowed] = numpy.nan
+        offered = numpy.nansum(per_share, axis=1) * signed_quantity
+        traded = signed_quantity * filled
+        new_q = self.quantity_outstanding[markets] + traded
+        self.quantity_outstanding[markets] = new_q
+        self.mu[markets] = 100.0 / (1.0 + numpy.exp(-new_q / self.max_loss))
+        user.cash[accounts] -= offered
+        self.user_account.cash[markets] += offered
+        user.shares[accounts] += traded
+        self.user_account.shares[markets] -= traded
+        if repeat is None:
+            return per_share[:, 0]
+        return per_share
+
+class EnsembleLMSRFactory(object):
+    def __init__(self, b):
+        self.b = b
+        self.name = 'LMSR (b=%1.2f)' % (b,)
+
+    def make(self, size):
+        return EnsembleLMSR(self.b, size)
+
+class EnsembleDraws(object):
+    '''BinomialDraws for many markets at once.'''
+    def __init__(self, size, rng, initial_p=None):
+        self.rng = rng
+        if initial_p is None:
+            self._p = rng.random_sample(size)
+        else:
+            assert 0.0 <= initial_p <= 1.0
+            self._p = numpy.empty(size)
+            self._p.fill(initial_p)
+
+    def do_jump(self, markets):
+        new_p = self._p[markets] + self.rng.normal(
+            0.0, information.JUMP_SIGMA, len(markets))
+        if information.TRUNCATE_AFTER:
+            new_p = numpy.clip(new_p, 0.0, 1.0)
+        else:
+            bad = (new_p < 0.0) | (new_p > 1.0)
+            while bad.any():
+                new_p[bad] = self._p[markets[bad]] + self.rng.normal(
+                    0.0, information.JUMP_SIGMA, numpy.count_nonzero(bad))
+                bad = (new_p < 0.0) | (new_p > 1.0)
+        self._p[markets] = new_p
+
+    def get_draw(self, members=1):
+        '''One draw per member per market, flattened like pair indices.'''
+        return (self.rng.random_sample((members, len(self._p)))
+                < self._p).astype(int).ravel()
+
+class EnsembleTradeHistory(object):
+    '''Append-only execution prices per market.'''
+    def __init__(self, size, capacity=256):
+        self.prices = numpy.zeros((size, capacity))
+        self.count = numpy.zeros(size, dtype=int)
+
+    def append(self, markets, execution_prices):
+        '''Appends one price per market, or a (len(markets), k) block of
+        consecutive prices; nan entries are skipped.'''
+        execution_prices = numpy.reshape(
+            execution_prices, (len(markets), -1))
+        executed = ~numpy.isnan(execution_prices)
+        counts = numpy.count_nonzero(executed, axis=1)
+        start = self.count[markets]
+        needed = (start + counts).max()
+        if needed > self.prices.shape[1]:
+            grown = numpy.zeros((self.prices.shape[0],
+                                 max(needed, 2 * self.prices.shape[1])))
+            grown[:, :self.prices.shape[1]] = self.prices
+            self.prices = grown
+        rows = numpy.broadcast_to(markets[:, numpy.newaxis],
+                                  execution_prices.shape)
+        columns = (start[:, numpy.newaxis]
+                   + numpy.arange(execution_prices.shape[1]))
+        self.prices[rows[executed], columns[executed]] = (
+            execution_prices[executed])
+        self.count[markets] += counts
+
+    def window(self, markets, end, length):
+        '''Prices at positions end - length .. end - 1 of each market.'''
+        columns = (end[:, numpy.newaxis] - length
+                   + numpy.arange(length)[numpy.newaxis, :])
+        return self.prices[markets[:, numpy.newaxis], columns]
+
+class EnsembleTrader(object):
+    '''A population of `members` traders of one type across `simulations`
+    markets. Callbacks and mu are aligned with the pairs passed to
+    trading_opportunity; pairs % simulations gives their markets.'''
+    name = 'generic'
+    def simulation_params(self, simulations, members, timesteps,
+                          possible_jump_locations,
+                          single_jump_probability):
+        self.simulations = simulations
+        self.members = members
+
+    def new_information(self, info, time):
+        pass
+
+    def trades_history(self, history, time):
+        pass
+
+    def trading_opportunity(self, pairs, cash_callback, shares_callback,
+                            check_callback, execute_callback, mu):
+        pass
+
+def leading_true(mask):
+    '''Length of the run of True values at the start of each row.'''
+    return numpy.where(mask.all(axis=1), mask.shape[1],
+                       numpy.argmin(mask, axis=1))
+
+def execute_feasible(buysell, curve, feasible, pairs, execute_callback,
+                     limit=200):
+    '''Vectorized other_bots.optimize_shares followed by execute_max:
+    the longest feasible run of amounts 1, 2, ... below limit. Prices
+    are monotone in the amount, so the first non-cancelled amount
+    counting down is the number of non-cancelled amounts up to shares.'''
+    shares = leading_true(feasible[:, :limit - 1])
+    amounts = numpy.arange(1, limit)[numpy.newaxis, :]
+    if buysell == 'buy':
+        accepted = curve < 100
+    else:
+        accepted = 0.01 < curve
+    shares = numpy.count_nonzero(
+        accepted & (amounts <= shares[:, numpy.newaxis]), axis=1)
+    trade = shares > 0
+    if trade.any():
+        execute_callback(buysell, shares[trade], pairs[trade])
+
+class MovingAverageEnsemble(EnsembleTrader):
+    name = other_bots.MovingAverageBot.name
+    lookahead = 8
+
+    def simulation_params(self, simulations, members, timesteps,
+                          possible_jump_locations,
+                          single_jump_probability,
+                          start_belief=50.0,
+                          alpha=0.9,
+                          min_block_size=2,
+                          start_block_size=20):
+        EnsembleTrader.simulation_params(
+            self, simulations, members, timesteps,
+            possible_jump_locations, single_jump_probability)
+        self.belief = numpy.empty(simulations * members)
+        self.belief.fill(start_belief)
+        self.alpha = alpha
+        self.min_block_size = min_block_size
+        self.start_block_size = start_block_size
+
+    def new_information(self, info, time):
+        self.belief = (self.belief * self.alpha
+                       + info * 100 * (1 - self.alpha))
+
+    def trading_opportunity(self, pairs, cash_callback, shares_callback,
+                            check_callback, execute_callback, mu):
+        current_belief = numpy.clip(
+            (self.belief[pairs] + mu) / 2.0, 1.0, 99.0)
+        bought_once = numpy.zeros(len(pairs), dtype=bool)
+        sold_once = numpy.zeros(len(pairs), dtype=bool)
+        block_size = numpy.empty(len(pairs), dtype=int)
+        block_size.fill(self.start_block_size)
+        active = numpy.arange(len(pairs))
+        lookahead = self.lookahead
+        while len(active):
+            active_pairs = pairs[active]
+            block = block_size[active]
+            belief = current_belief[active][:, numpy.newaxis]
+            # How many blocks in a row the scalar loop would buy (sell)
+            # before the price crosses the belief.
+            buys = leading_true(check_callback(
+                    'buy', block, active_pairs, repeat=lookahead) < belief)
+            buys[sold_once[active]] = 0
+            sells = leading_true(check_callback(
+                    'sell', block, active_pairs, repeat=lookahead) > belief)
+            sells[(buys > 0) | bought_once[active]] = 0
+            buy = buys > 0
+            if buy.any():
+                execute_callback('buy', block[buy], active_pairs[buy],
+                                 repeat=buys[buy])
+                bought_once[active[buy]] = True
+            sell = sells > 0
+            if sell.any():
+                execute_callback('sell', block[sell], active_pairs[sell],
+                                 repeat=sells[sell])
+                sold_once[active[sell]] = True
+            # A run shorter than the lookahead stopped at a block the bot
+            # would not trade, so the next pass at this size is idle.
+            idle = numpy.maximum(buys, sells) < lookahead
+            done = idle & (block == self.min_block_size)
+            shrink = active[idle & ~done]
+            block_size[shrink] = numpy.maximum(
+                block_size[shrink] // 2, self.min_block_size)
+            active = active[~done]
+
+class ShortLongEnsemble(EnsembleTrader):
+    name = other_bots.ShortLongTechnical.name
+    NONE, HIGH, LOW = 0, 1, 2
+    BUY, SELL = 1, -1
+
+    def simulation_params(self, simulations, members, timesteps,
+                          possible_jump_locations,
+                          single_jump_probability,
+                          short_length=10, long_length=30,
+                          max_long_exceed=2.0, max_short_exceed=2.0,
+                          margin=0.05):
+        EnsembleTrader.simulation_params(
+            self, simulations, members, timesteps,
+            possible_jump_locations, single_jump_probability)
+        self.short_length = short_length
+        self.long_length = long_length
+        self.max_long_exceed = max_long_exceed
+        self.max_short_exceed = max_short_exceed
+        self.margin = margin
+        self.state = numpy.zeros((members, simulations), dtype=int)
+        self.trade = numpy.zeros((members, simulations), dtype=int)
+        # The averages only depend on the market, not on the member.
+        self.long_average = numpy.zeros(simulations)
+        self.short_average = numpy.zeros(simulations)
+
+    def trades_history(self, history, time):
+        enough = history.count >= self.long_length
+        self.trade[:, ~enough] = 0
+        markets = numpy.flatnonzero(enough)
+        if not len(markets):
+            return
+        end = history.count[markets]
+        short = history.window(markets, end, self.short_length).mean(axis=1)
+        long_ = history.window(markets, end, self.long_length).mean(axis=1)
+        self.short_average[markets] = short
+        self.long_average[markets] = long_
+        state = self.state[:, markets]
+        trade = self.trade[:, markets]
+        fresh = state == self.NONE
+        trade[fresh] = 0
+        state[fresh] = numpy.where(short > long_, self.HIGH,
+                                   self.LOW)[numpy.nonzero(fresh)[1]]
+        to_low = (~fresh & (state == self.HIGH)
+                  & (long_ > short + self.margin * short))
+        to_high = (~fresh & (state == self.LOW)
+                   & (long_ < short - self.margin * short))
+        state[to_low] = self.LOW
+        trade[to_low] = self.SELL
+        state[to_high] = self.HIGH
+        trade[to_high] = self.BUY
+        self.state[:, markets] = state
+        self.trade[:, markets] = trade
+
+    def trading_opportunity(self, pairs, cash_callback, shares_callback,
+                            check_callback, execute_callback, mu):
+        amounts = numpy.arange(1, 200, dtype=float)[numpy.newaxis, :]
+        trade = self.trade.ravel()[pairs]
+        for side, buysell in ((self.SELL, 'sell'), (self.BUY, 'buy')):
+            selected = pairs[trade == side]
+            if not len(selected):
+                continue
+            markets = selected % self.simulations
+            curve = check_callback(buysell, amounts, selected)
+            long_ = self.long_average[markets][:, numpy.newaxis]
+            short = self.short_average[markets][:, numpy.newaxis]
+            if buysell == 'sell':
+                feasible = ((curve >= long_ - self.max_long_exceed)
+                            & (curve >= short - self.max_short_exceed))
+            else:
+                feasible = ((curve <= long_ + self.max_long_exceed)
+                            & (curve <= short + self.max_short_exceed))
+            feasible &= (curve < 100.0) & (curve > 0.0)
+            execute_feasible(buysell, curve, feasible, selected,
+                             execute_callback)
+
+class RangeEnsemble(EnsembleTrader):
+    name = other_bots.RangeTechnical.name
+
+    def simulation_params(self, simulations, members, timesteps,
+                          possible_jump_locations,
+                          single_jump_probability,
+                          window=20, margin=0.05, max_exceed=2.0):
+        EnsembleTrader.simulation_params(
+            self, simulations, members, timesteps,
+            possible_jump_locations, single_jump_probability)
+        self.window = window
+        self.margin = margin
+        self.max_exceed = max_exceed
+        self.history = None
+        self.count = None
+
+    def trades_history(self, history, time):
+        # RangeTechnical copies the list, so only the trades up to the
+        # start of the round count.
+        self.history = history
+        self.count = history.count.copy()
+
+    def trading_opportunity(self, pairs, cash_callback, shares_callback,
+                            check_callback, execute_callback, mu):
+        markets = pairs % self.simulations
+        enough = self.count[markets] >= self.window + 1
+        pairs = pairs[enough]
+        markets = markets[enough]
+        if not len(pairs):
+            return
+        end = self.count[markets]
+        window_trades = self.history.window(markets, end - 1, self.window)
+        min_price = window_trades.min(axis=1)
+        max_price = window_trades.max(axis=1)
+        last = self.history.prices[markets, end - 1]
+        buy = last > max_price + max_price * self.margin
+        sell = ~buy & (last < min_price - min_price * self.margin)
+        amounts = numpy.arange(1, 200, dtype=float)[numpy.newaxis, :]
+        for mask, buysell in ((buy, 'buy'), (sell, 'sell')):
+            if not mask.any():
+                continue
+            selected = pairs[mask]
+            curve = check_callback(buysell, amounts, selected)
+            if buysell == 'buy':
+                limit = max_price[mask][:, numpy.newaxis]
+                feasible = curve <= limit + self.max_exceed
+            else:
+                limit = min_price[mask][:, numpy.newaxis]
+                feasible = curve >= limit - self.max_exceed
+            feasible &= (curve > 0.0) & (curve < 100.0)
+            execute_feasible(buysell, curve, feasible, selected,
+                             execute_callback)
+
+ENSEMBLE_TRADERS = {
+    other_bots.MovingAverageBot: MovingAverageEnsemble,
+    other_bots.ShortLongTechnical: ShortLongEnsemble,
+    other_bots.RangeTechnical: RangeEnsemble,
+}
+
+def vectorize(trader_list):
+    '''Groups the scalar traders into ensemble populations. Returns a
+    list of (population, number of members) in first-seen order.'''
+    ret = []
+    members = {}
+    for trader in trader_list:
+        if type(trader) not in ENSEMBLE_TRADERS:
+            raise ValueError('No ensemble counterpart for trader %s'
+                             % (trader.name,))
+        if getattr(trader, 'params', None):
+            raise ValueError('Ensemble traders only use default '
+                             'parameters, not %s for %s'
+                             % (trader.params, trader.name))
+        if type(trader) not in members:
+            members[type(trader)] = len(ret)
+            ret.append([ENSEMBLE_TRADERS[type(trader)](), 0])
+        ret[members[type(trader)]][1] += 1
+    return [tuple(population) for population in ret]
+
+def make_cash_callback(user):
+    def cash_callback(pairs):
+        return user.cash[pairs]
+    return cash_callback
+
+def make_shares_callback(user):
+    def shares_callback(pairs):
+        return user.shares[pairs]
+    return shares_callback
+
+def make_check_callback(market_maker, size):
+    def check_callback(buysell, quantity, pairs, repeat=None):
+        assert buysell in ['buy', 'sell']
+        return market_maker.price_check(buysell, quantity, pairs % size,
+                                        repeat=repeat)
+    return check_callback
+
+def make_execute_callback(market_maker, user, history, size):
+    def execute_callback(buysell, quantity, pairs, repeat=None):
+        assert buysell in ['buy', 'sell']
+        markets = pairs % size
+        executed = market_maker.execute(buysell, quantity, markets, user,
+                                        pairs, repeat=repeat)
+        history.append(markets, executed)
+        return executed
+    return execute_callback
+
+class EnsembleSimulation(object):
+    '''Runs `simulations` independent copies of simulation.Simulation in
+    lockstep. trader_list holds (EnsembleTrader, members) pairs as
+    returned by vectorize.'''
+    def __init__(self, simulations, timesteps, market_fact, trader_list,
+                 initial_cash=0, initial_shares=0,
+                 jump_probability=None, initial_p=None, seed=None):
+        self.simulations = simulations
+        self.traders = trader_list
+        self.possible_jump_locations = [a for a in range(timesteps)]
+        if jump_probability is None:
+            self.jump_probability = 1.0 / float(len(
+                    self.possible_jump_locations))
+        else:
+            self.jump_probability = jump_probability
+        self.initial_cash = initial_cash
+        self.initial_shares = initial_shares
+        self.timesteps = timesteps
+        self.market_fact = market_fact
+        self.initial_p = initial_p
+        self.rng = numpy.random.RandomState(seed)
+        self.p_final = None
+        self.user_list = None
+        self.liquidation = None
+        self.market_maker_user = None
+
+    def simulate(self):
+        size = self.simulations
+        rng = self.rng
+        market = self.market_fact.make(size)
+        history = EnsembleTradeHistory(size)
+        check_callback = make_check_callback(market, size)
+        users = []
+        callbacks = []
+        population_of = []
+        member_of = []
+        for i, (trader, members) in enumerate(self.traders):
+            trader.simulation_params(size, members, self.timesteps,
+                                     self.possible_jump_locations,
+                                     self.jump_probability)
+            user = EnsembleUser(size * members, self.initial_cash,
+                                self.initial_shares, name=trader.name)
+            users.append(user)
+            callbacks.append((make_cash_callback(user),
+                              make_shares_callback(user),
+                              make_execute_callback(market, user, history,
+                                                    size)))
+            population_of.extend([i] * members)
+            member_of.extend(range(members))
+        population_of = numpy.array(population_of)
+        member_of = numpy.array(member_of)
+        binom = EnsembleDraws(size, rng, self.initial_p)
+        alive = numpy.arange(size)
+        for i in range(self.timesteps):
+            jumps = alive[rng.random_sample(len(alive))
+                          < self.jump_probability]
+            if len(jumps):
+                binom.do_jump(jumps)
+            p = binom._p[alive]
+            alive = alive[(p != 1.0) & (p != 0.0)]
+            if not len(alive):
+                break
+            for trader, members in self.traders:
+                trader.trades_history(history, i)
+                trader.new_information(binom.get_draw(members), i)
+            # Each market gets its own random trading order; at every
+            # position, hand each population the markets where one of its
+            # members is next.
+            order = numpy.argsort(
+                rng.random_sample((len(alive), len(member_of))), axis=1)
+            for position in range(len(member_of)):
+                turn = order[:, position]
+                for j, (trader, members) in enumerate(self.traders):
+                    mine = population_of[turn] == j
+                    if not mine.any():
+                        continue
+                    markets = alive[mine]
+                    pairs = member_of[turn[mine]] * size + markets
+                    cash_callback, shares_callback, execute_callback = (
+                        callbacks[j])
+                    trader.trading_opportunity(
+                        pairs, cash_callback, shares_callback,
+                        check_callback, execute_callback,
+                        market.mu[markets])
+        self.p_final = binom._p
+        self.user_list = [(owner.name, account)
+                          for (owner, members), account in zip(self.traders,
+                                                               users)]
+        self.liquidation = 100.0 * binom._p
+        self.market_maker_user = market.user_account
+
+    def profits_by_user(self):
+        '''Like Simulation.profits_by_user, with one array entry per
+        simulation.'''
+        assert self.user_list is not None
+        ret = {self.market_fact.name:self.market_maker_user.profit(
+                self.liquidation)}
+        for trader_name, user in self.user_list:
+            profit = user.profit(numpy.tile(
+                    self.liquidation, len(user.cash) // self.simulations))
+            profit = profit.reshape(-1, self.simulations).sum(axis=0)
+            if trader_name in ret:
+                ret[trader_name] = ret[trader_name] + profit
+            else:
+                ret[trader_name] = profit
+        return ret
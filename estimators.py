@@ -0,0 +1,180 @@
+import collections
+import math
+import numpy
+
+def normal_isf(q):
+    '''x with P(Z > x) = q for a standard normal Z. Bisection on
+    math.erfc, then Newton steps for full precision.'''
+    tail = lambda x: 0.5 * math.erfc(x / math.sqrt(2.0))
+    low, high = -40.0, 40.0
+    for _ in range(100):
+        mid = (low + high) / 2.0
+        if tail(mid) > q:
+            low = mid
+        else:
+            high = mid
+    x = (low + high) / 2.0
+    for _ in range(3):
+        density = math.exp(-x * x / 2.0) / math.sqrt(2.0 * math.pi)
+        x += (tail(x) - q) / density
+    return x
+
+class BernoulliEstimator(object):
+    '''Running estimate of p from a stream of 0/1 draws, with the count
+    over the last window_length draws kept alongside.'''
+    def __init__(self, window_length=None, alpha=0.05):
+        self.window_length = window_length
+        self.alpha = alpha
+        self.z = normal_isf(alpha / 2.0)
+        self.reset()
+
+    def reset(self, successes=0, trials=0):
+        '''Start over, optionally from counts already seen.'''
+        self.successes = successes
+        self.trials = trials
+        self.window = collections.deque()
+        self.window_successes = 0
+
+    def update(self, info):
+        self.successes += info
+        self.trials += 1
+        if self.window_length is not None:
+            self.window.append(info)
+            self.window_successes += info
+            if len(self.window) > self.window_length:
+                self.window_successes -= self.window.popleft()
+
+    def p(self):
+        return self.successes / float(self.trials)
+
+    def window_p(self):
+        return self.window_successes / float(len(self.window))
+
+    def interval(self, method='normal'):
+        '''(low, high) confidence interval for p at level 1 - alpha.
+        'normal' is the Wald interval, clipped to [0, 1] like statsmodels'
+        proportion_confint; 'wilson' behaves better near 0 and 1 and for
+        few trials.'''
+        p = self.p()
+        n = float(self.trials)
+        z = self.z
+        if method == 'normal':
+            half = z * math.sqrt(p * (1 - p) / n)
+            return max(p - half, 0.0), min(p + half, 1.0)
+        elif method == 'wilson':
+            denominator = 1 + z * z / n
+            center = (p + z * z / (2 * n)) / denominator
+            half = (z / denominator) * math.sqrt(
+                p * (1 - p) / n + z * z / (4 * n * n))
+            return center - half, center + half
+        raise ValueError('Unknown interval method %s' % (method,))
+
+class CusumDetector(object):
+    '''Two-sided CUSUM test for a jump of about `shift` in the p of a
+    Bernoulli stream. Each update is O(1). After an alarm, `since` holds
+    (successes, trials) from the estimated change point on.'''
+    def __init__(self, shift=0.2, threshold=6.0):
+        self.shift = shift
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.up = 0.0
+        self.down = 0.0
+        self.up_since = (0, 0)
+        self.down_since = (0, 0)
+        self.since = None
+
+    def _step(self, statistic, since, info, p0, p1):
+        if info:
+            statistic += math.log(p1 / p0)
+        else:
+            statistic += math.log((1 - p1) / (1 - p0))
+        if statistic <= 0.0:
+            return 0.0, (0, 0)
+        return statistic, (since[0] + info, since[1] + 1)
+
+    def update(self, info, p):
+        '''Test draw info against the current estimate p. Returns True
+        when a jump is detected.'''
+        p0 = min(max(p, 0.01), 0.99)
+        self.up, self.up_since = self._step(
+            self.up, self.up_since, info, p0, min(p0 + self.shift, 0.99))
+        self.down, self.down_since = self._step(
+            self.down, self.down_since, info, p0, max(p0 - self.shift, 0.01))
+        if self.up > self.threshold:
+            since = self.up_since
+        elif self.down > self.threshold:
+            since = self.down_since
+        else:
+            return False
+        self.reset()
+        self.since = since
+        return True
+
+class RunningStats(object):
+    '''Count, mean, variance, min and max of a stream of numbers, using
+    Welford's update. Two RunningStats merge exactly (Chan et al.).'''
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / float(count)
+        self.m2 += (other.m2
+                    + delta * delta * self.count * other.count / float(count))
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def update_many(self, values):
+        '''Fold in a numpy array of values at once.'''
+        values = numpy.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        batch = RunningStats()
+        batch.count = len(values)
+        batch.mean = float(values.mean())
+        batch.m2 = float(((values - batch.mean) ** 2).sum())
+        batch.min = float(values.min())
+        batch.max = float(values.max())
+        self.merge(batch)
+
+    def variance(self, ddof=0):
+        if self.count <= ddof:
+            return float('nan')
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        return math.sqrt(self.variance(ddof))
+
+    def as_dict(self):
+        return {'count':self.count, 'mean':self.mean, 'm2':self.m2,
+                'min':self.min, 'max':self.max}
+
+    @classmethod
+    def from_dict(cls, values):
+        stats = cls()
+        stats.__dict__.update(values)
+        return stats
+
+    def stderr(self):
+        '''Standard error of the mean.'''
+        return self.std(ddof=1) / math.sqrt(self.count)
@@ -1,12 +1,17 @@
+import numpy
+import os
 import random
 
 JUMP_SIGMA = 0.2
 TRUNCATE_AFTER = True
 
 class BinomialDraws(object):
-    def __init__(self, initial_p=None):
+    def __init__(self, initial_p=None, rng=None):
+        # any object with random() and normalvariate(), such as a
+        # random.Random; the global random module by default
+        self.rng = random if rng is None else rng
         if initial_p is None:
-            self._p = random.random()
+            self._p = self.rng.random()
         else:
             assert 0.0 <= initial_p <= 1.0
             self._p = initial_p
@@ -16,7 +21,7 @@ class BinomialDraws(object):
     def do_jump(self):
         have_good_p = False
         while not have_good_p:
-            delta_p = random.normalvariate(0.0, JUMP_SIGMA)
+            delta_p = self.rng.normalvariate(0.0, JUMP_SIGMA)
             new_p = delta_p + self._p
             if TRUNCATE_AFTER:
                 new_p = min(max(new_p, 0.0), 1.0)
@@ -27,7 +32,238 @@ class BinomialDraws(object):
         self._p = new_p
 
     def get_draw(self):
-        if random.random() < self._p:
+        if self.rng.random() < self._p:
             return 1
         else:
             return 0
+
+    def steps(self, timesteps, jump_probability):
+        '''(p, get_draw) for each timestep, jumping first with
+        jump_probability. jumps records whether each timestep so far
+        jumped.'''
+        self.jumps = []
+        for i in xrange(timesteps):
+            jump = self.rng.random() < jump_probability
+            if jump:
+                self.do_jump()
+            self.jumps.append(jump)
+            yield self._p, self.get_draw
+
+# A jump moves an outcome's logit by about as much as a JUMP_SIGMA move
+# in p near p = 0.5, where dp/dlogit is 1/4.
+LOGIT_JUMP_SIGMA = 4 * JUMP_SIGMA
+
+class OutcomeDraws(object):
+    '''True outcome probabilities of `markets` markets with `outcomes`
+    outcomes each, drawn uniformly from the simplex. At every timestep
+    each market jumps with jump_probability, moving its logits by normal
+    noise. rng is a numpy.random.RandomState.'''
+    def __init__(self, markets, outcomes, rng=None):
+        self.rng = numpy.random if rng is None else rng
+        self.logits = numpy.log(
+            self.rng.standard_exponential((markets, outcomes)))
+        self._p = None
+        self._update()
+
+    def _update(self):
+        e = numpy.exp(self.logits - self.logits.max(axis=1)[:, numpy.newaxis])
+        self._p = e / e.sum(axis=1)[:, numpy.newaxis]
+
+    def steps(self, timesteps, jump_probability):
+        '''The markets x outcomes array of probabilities for each
+        timestep, after that timestep's jumps. The array is not copied.'''
+        markets, outcomes = self.logits.shape
+        for i in xrange(timesteps):
+            jumps = numpy.flatnonzero(
+                self.rng.random_sample(markets) < jump_probability)
+            if len(jumps):
+                self.logits[jumps] += self.rng.normal(
+                    0.0, LOGIT_JUMP_SIGMA, (len(jumps), outcomes))
+                self._update()
+            yield self._p
+
+    def draws(self, p, contracts):
+        '''One 0/1 draw for each entry of contracts, an array of flat
+        (market * outcomes + outcome) indices into p.'''
+        return (self.rng.random_sample(len(contracts))
+                < p.ravel()[contracts]).astype(numpy.uint8)
+
+class InformationPath(object):
+    '''A whole information path: p_vec, the jump schedule and a
+    timestep x trader matrix of draws. Like a simulation, it stops at
+    the first timestep where p reaches 0 or 1.'''
+    def __init__(self, p_vec, jumps, draws):
+        self.p_vec = p_vec
+        self.jumps = jumps
+        self.draws = draws
+
+    def __len__(self):
+        return len(self.p_vec)
+
+    def steps(self):
+        '''(p, get_draw) for each timestep, get_draw hands out that
+        timestep's draws in turn.'''
+        for i in xrange(len(self.p_vec)):
+            draws = iter(self.draws[i].tolist())
+            yield float(self.p_vec[i]), draws.next
+
+def generate_path(timesteps, traders, jump_probability, initial_p=None,
+                  rng=None, antithetic=False):
+    '''Draw an InformationPath for `traders` traders in one pass.
+    rng is a numpy.random.RandomState, the global one by default. With
+    antithetic, the same random numbers are mirrored (u becomes 1 - u,
+    jumps change sign), giving the antithetic partner of the path drawn
+    from the same rng state.'''
+    if rng is None:
+        rng = numpy.random
+    sign = -1.0 if antithetic else 1.0
+    mirror = lambda u: 1.0 - u if antithetic else u
+    if initial_p is None:
+        initial_p = mirror(rng.random_sample())
+    assert 0.0 <= initial_p <= 1.0
+    jumps = mirror(rng.random_sample(timesteps)) < jump_probability
+    deltas = numpy.where(jumps,
+                         sign * rng.normal(0.0, JUMP_SIGMA, timesteps), 0.0)
+    if TRUNCATE_AFTER:
+        p_vec = initial_p + numpy.cumsum(deltas)
+        outside = numpy.flatnonzero((p_vec <= 0.0) | (p_vec >= 1.0))
+        if len(outside):
+            p_vec = p_vec[:outside[0] + 1]
+            p_vec[-1] = min(max(p_vec[-1], 0.0), 1.0)
+            jumps = jumps[:len(p_vec)]
+    else:
+        # resample jumps that leave [0, 1], one at a time
+        p_vec = numpy.empty(timesteps)
+        p = initial_p
+        for i in xrange(timesteps):
+            if jumps[i]:
+                new_p = p + deltas[i]
+                while not 0.0 <= new_p <= 1.0:
+                    new_p = p + sign * rng.normal(0.0, JUMP_SIGMA)
+                p = new_p
+            p_vec[i] = p
+        outside = numpy.flatnonzero((p_vec == 0.0) | (p_vec == 1.0))
+        if len(outside):
+            p_vec = p_vec[:outside[0] + 1]
+            jumps = jumps[:len(p_vec)]
+    draws = (mirror(rng.random_sample((len(p_vec), traders)))
+             < p_vec[:, numpy.newaxis]).astype(numpy.uint8)
+    return InformationPath(p_vec, jumps, draws)
+
+class PathBank(object):
+    '''InformationPaths stored as arrays padded to `timesteps`, one .npy
+    file per array in a directory. load() memory-maps the files, so
+    every process reading a bank only pages in the paths it uses.'''
+    FILES = ['p_vec', 'lengths', 'jumps', 'draws']
+
+    def __init__(self, p_vec, lengths, jumps, draws):
+        self.p_vec = p_vec
+        self.lengths = lengths
+        self.jumps = jumps
+        self.draws = draws
+
+    @classmethod
+    def from_paths(cls, paths, timesteps, traders):
+        p_vec = numpy.zeros((len(paths), timesteps))
+        lengths = numpy.zeros(len(paths), dtype=numpy.int32)
+        jumps = numpy.zeros((len(paths), timesteps), dtype=bool)
+        draws = numpy.zeros((len(paths), timesteps, traders),
+                            dtype=numpy.uint8)
+        for i, path in enumerate(paths):
+            length = len(path)
+            lengths[i] = length
+            p_vec[i, :length] = path.p_vec
+            jumps[i, :length] = path.jumps
+            draws[i, :length] = path.draws
+        return cls(p_vec, lengths, jumps, draws)
+
+    @classmethod
+    def load(cls, directory):
+        return cls(*[numpy.load(os.path.join(directory, name + '.npy'),
+                                mmap_mode='r')
+                     for name in cls.FILES])
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in self.FILES:
+            numpy.save(os.path.join(directory, name + '.npy'),
+                       getattr(self, name))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def timesteps(self):
+        return self.p_vec.shape[1]
+
+    @property
+    def traders(self):
+        return self.draws.shape[2]
+
+    def path(self, index):
+        length = self.lengths[index]
+        return InformationPath(self.p_vec[index, :length],
+                               self.jumps[index, :length],
+                               self.draws[index, :length])
+
+ORDER_DTYPE = numpy.dtype([('time', numpy.int32), ('trader', numpy.int16),
+                           ('side', numpy.int8), ('quantity', numpy.float64)])
+SIDES = ['buy', 'sell']
+
+class Scenario(InformationPath):
+    '''An InformationPath recorded by a Simulation, with what it takes to
+    replay the order flow: schedule holds each timestep's trader indices
+    in the order they traded (-1 padded), draw_columns the column of
+    draws each trader got, and orders the executed orders in the order
+    they were made, with side an index into SIDES.'''
+    def __init__(self, p_vec, jumps, draws, schedule, draw_columns,
+                 orders):
+        InformationPath.__init__(self, p_vec, jumps, draws)
+        self.schedule = schedule
+        self.draw_columns = draw_columns
+        self.orders = orders
+
+class ScenarioBank(PathBank):
+    '''Scenarios stored like a PathBank. orders holds the orders of all
+    scenarios back to back, scenario i's from order_offsets[i] to
+    order_offsets[i + 1].'''
+    FILES = PathBank.FILES + ['schedule', 'draw_columns', 'orders',
+                              'order_offsets']
+
+    def __init__(self, p_vec, lengths, jumps, draws, schedule,
+                 draw_columns, orders, order_offsets):
+        PathBank.__init__(self, p_vec, lengths, jumps, draws)
+        self.schedule = schedule
+        self.draw_columns = draw_columns
+        self.orders = orders
+        self.order_offsets = order_offsets
+
+    @classmethod
+    def from_scenarios(cls, scenarios, timesteps, traders):
+        paths = PathBank.from_paths(scenarios, timesteps, traders)
+        schedule = numpy.empty((len(scenarios), timesteps, traders),
+                               dtype=numpy.int16)
+        schedule.fill(-1)
+        draw_columns = numpy.zeros((len(scenarios), traders),
+                                   dtype=numpy.int16)
+        order_offsets = numpy.zeros(len(scenarios) + 1, dtype=numpy.int64)
+        for i, scenario in enumerate(scenarios):
+            schedule[i, :len(scenario)] = scenario.schedule
+            draw_columns[i] = scenario.draw_columns
+            order_offsets[i + 1] = order_offsets[i] + len(scenario.orders)
+        orders = numpy.concatenate(
+            [scenario.orders for scenario in scenarios]
+            or [numpy.zeros(0, dtype=ORDER_DTYPE)])
+        return cls(paths.p_vec, paths.lengths, paths.jumps, paths.draws,
+                   schedule, draw_columns, orders, order_offsets)
+
+    def path(self, index):
+        length = self.lengths[index]
+        return Scenario(self.p_vec[index, :length],
+                        self.jumps[index, :length],
+                        self.draws[index, :length],
+                        self.schedule[index, :length],
+                        self.draw_columns[index],
+                        self.orders[self.order_offsets[index]:
+                                    self.order_offsets[index + 1]])
@@ -0,0 +1,391 @@
+"""A market maker serving many concurrently trading bots, with latency
+and throughput metrics, and a load generator driving the bots in
+other_bots against it:
+
+    python market_server.py --bots 40 --rounds 100
+    python market_server.py --bots 40 --rounds 100 --socket
+
+One thread owns the market maker and serves requests off a queue in
+arrival order. Bots run in threads of their own and reach it through a
+Client, in process, or a SocketClient, over a local TCP socket with one
+JSON request per line. The bots trade round by round: they all take
+round i's trading opportunity, concurrently, before any takes round
+i + 1's.
+"""
+import argparse
+import estimators
+import information
+import json
+import numpy
+import other_bots
+import prices
+import profiling
+import Queue
+import socket
+import SocketServer
+import sys
+import threading
+import traders
+
+class MarketServer(object):
+    '''Serves requests (op, user name, args...) for market_maker in the
+    order they arrive. Users are created on their first request. Ops:
+    check, check_many, quantity and execute work like the simulation
+    callbacks; cash, shares, mu and trades(since) report state.'''
+    def __init__(self, market_maker, initial_cash=0, initial_shares=0):
+        self.market_maker = market_maker
+        self.initial_cash = initial_cash
+        self.initial_shares = initial_shares
+        self.requests = Queue.Queue()
+        self.users = {}
+        # (execution_price, buysell, quantity, previous mu), like
+        # Log.execution_prices
+        self.execution_prices = []
+        self.served = {}
+        self.started = None
+        self.stopped = None
+        self.thread = None
+
+    def start(self):
+        self.started = profiling.clock()
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.requests.put(None)
+        self.thread.join()
+        self.stopped = profiling.clock()
+
+    def submit(self, request, reply):
+        '''Queue a request; reply((ok, result)) is called with the
+        result, or with (False, message) if it failed.'''
+        self.requests.put((request, reply))
+
+    def _serve(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, reply = item
+            try:
+                response = (True, self.handle(*request))
+            except Exception, e:
+                response = (False, '%s: %s' % (type(e).__name__, e))
+            self.served[request[0]] = self.served.get(request[0], 0) + 1
+            reply(response)
+
+    def user(self, name):
+        user = self.users.get(name)
+        if user is None:
+            user = self.users[name] = prices.User(
+                self.initial_cash,
+                {self.market_maker.id:self.initial_shares}, name=name)
+        return user
+
+    def handle(self, op, name, *args):
+        market_maker = self.market_maker
+        user = self.user(name)
+        if op == 'check':
+            buysell, quantity = args
+            return prices.check(buysell, quantity, market_maker, user)
+        elif op == 'check_many':
+            buysell, quantities = args
+            return prices.check_many(buysell, quantities, market_maker,
+                                     user).tolist()
+        elif op == 'quantity':
+            buysell, price, marginal = args
+            return prices.max_quantity(buysell, price, market_maker, user,
+                                       marginal)
+        elif op == 'execute':
+            buysell, quantity = args
+            previous_mu = market_maker.mu
+            price = prices.execute(buysell, quantity, market_maker, user)
+            if price is not None:
+                self.execution_prices.append(
+                    (price, buysell, quantity, previous_mu))
+            return price
+        elif op == 'cash':
+            return user.cash
+        elif op == 'shares':
+            return user.shares.get(market_maker.id, 0)
+        elif op == 'mu':
+            return market_maker.mu
+        elif op == 'trades':
+            since, = args
+            return self.execution_prices[since:]
+        raise ValueError('Unknown request %s' % (op,))
+
+    def metrics(self):
+        '''Requests served by op, and per second over the time served.'''
+        stopped = self.stopped
+        if stopped is None:
+            stopped = profiling.clock()
+        elapsed = stopped - self.started
+        requests = sum(self.served.values())
+        return {'elapsed':elapsed, 'served':dict(self.served),
+                'requests_per_second':requests / elapsed,
+                'orders_per_second':self.served.get('execute', 0) / elapsed}
+
+    def profits(self, value):
+        '''{user name: profit} with a share worth value.'''
+        liquidation = {self.market_maker.id:value}
+        return dict((name, user.profit(liquidation))
+                    for name, user in self.users.iteritems())
+
+class Client(object):
+    '''One bot's connection to an in-process MarketServer, for use from a
+    single thread. Keeps the round-trip latency of each op.'''
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+        self.replies = Queue.Queue()
+        self.latency = {}
+
+    def _roundtrip(self, request):
+        self.server.submit(request, self.replies.put)
+        return self.replies.get()
+
+    def request(self, op, *args):
+        start = profiling.clock()
+        ok, result = self._roundtrip((op, self.name) + args)
+        stats = self.latency.get(op)
+        if stats is None:
+            stats = self.latency[op] = estimators.RunningStats()
+        stats.update(profiling.clock() - start)
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def close(self):
+        pass
+
+    # callbacks for Trader.trading_opportunity
+
+    def cash_callback(self):
+        return self.request('cash')
+
+    def shares_callback(self):
+        return self.request('shares')
+
+    def check_callback(self, buysell, quantity):
+        return self.request('check', buysell, quantity)
+
+    def execute_callback(self, buysell, quantity):
+        return self.request('execute', buysell, quantity)
+
+    def quantity_callback(self, buysell, price, marginal=False):
+        return self.request('quantity', buysell, price, marginal)
+
+    def check_many_callback(self, buysell, quantities):
+        return numpy.array(self.request(
+                'check_many', buysell, numpy.asarray(quantities).tolist()))
+
+class SocketClient(Client):
+    '''A Client talking to a SocketFrontEnd at address.'''
+    def __init__(self, address, name):
+        Client.__init__(self, None, name)
+        self.socket = socket.create_connection(address)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.socket.makefile('rb')
+
+    def _roundtrip(self, request):
+        self.socket.sendall(json.dumps(request) + '\n')
+        return json.loads(self.rfile.readline())
+
+    def close(self):
+        self.rfile.close()
+        self.socket.close()
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                   1)
+
+    def handle(self):
+        replies = Queue.Queue()
+        for line in self.rfile:
+            self.server.market_server.submit(tuple(json.loads(line)),
+                                             replies.put)
+            self.wfile.write(json.dumps(replies.get()) + '\n')
+            self.wfile.flush()
+
+class SocketFrontEnd(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''Serves a MarketServer on a TCP socket, a thread per connection.'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, market_server, address=('127.0.0.1', 0)):
+        SocketServer.TCPServer.__init__(self, address, RequestHandler)
+        self.market_server = market_server
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+class RoundBarrier(object):
+    '''Blocks each of parties threads in wait() until all of them have
+    called it, like Python 3's threading.Barrier. A thread that is done
+    calls leave() so the others no longer wait for it.'''
+    def __init__(self, parties):
+        self.parties = parties
+        self.waiting = 0
+        self.generation = 0
+        self.condition = threading.Condition()
+
+    def _release(self):
+        self.waiting = 0
+        self.generation += 1
+        self.condition.notify_all()
+
+    def wait(self):
+        with self.condition:
+            generation = self.generation
+            self.waiting += 1
+            if self.waiting >= self.parties:
+                self._release()
+                return
+            while generation == self.generation:
+                self.condition.wait()
+
+    def leave(self):
+        with self.condition:
+            self.parties -= 1
+            if self.waiting and self.waiting >= self.parties:
+                self._release()
+
+class OrderLimit(Exception):
+    '''Raised by a bot's execute callback once it has used up the
+    executes of its trading opportunity.'''
+
+def bot_loop(bot, client, path, column, rounds, barrier=None,
+             max_executes=50):
+    '''Trade bot through client for the rounds of an InformationPath,
+    waiting at barrier before each round if given. A trading
+    opportunity ends after max_executes executes, so bots on either
+    side of the price can not trade against each other for ever while
+    they share a round.'''
+    try:
+        bot.simulation_params(rounds, range(rounds), 1.0 / rounds,
+                              **getattr(bot, 'params', {}))
+        keywords = dict((callback, getattr(client, callback))
+                        for callback in traders.optional_callbacks(bot))
+        executes = [0]
+        def execute_callback(buysell, quantity):
+            if executes[0] >= max_executes:
+                raise OrderLimit()
+            executes[0] += 1
+            return client.execute_callback(buysell, quantity)
+        trades = []
+        for i in xrange(min(rounds, len(path))):
+            if barrier is not None:
+                barrier.wait()
+            new_trades = [tuple(trade) for trade in
+                          client.request('trades', len(trades))]
+            trades.extend(new_trades)
+            bot.trades_history(trades, i)
+            bot.new_trades(new_trades, i)
+            bot.new_information(int(path.draws[i, column]), i)
+            executes[0] = 0
+            try:
+                bot.trading_opportunity(
+                    client.cash_callback, client.shares_callback,
+                    client.check_callback, execute_callback,
+                    client.request('mu'), **keywords)
+            except OrderLimit:
+                pass
+    finally:
+        if barrier is not None:
+            barrier.leave()
+        client.close()
+
+def load_test(bots, rounds=100, lmsr_b=250, use_socket=False, seed=None,
+              max_executes=50):
+    '''Run every bot in its own thread against one LMSR served by a
+    MarketServer, in process or over a local socket. The bots draw their
+    information from one InformationPath and trade the rounds in step,
+    at most max_executes executes per trading opportunity (see
+    bot_loop). Returns the server metrics, with the clients' round-trip
+    latency per op merged in, and the profits by bot name (and the
+    market maker's) at the path's final p.'''
+    path = information.generate_path(
+        rounds, len(bots), 1.0 / rounds,
+        rng=numpy.random.RandomState(seed))
+    market_fact = prices.LMSRFactory(lmsr_b)
+    market_maker = market_fact.make()
+    server = MarketServer(market_maker)
+    front_end = None
+    if use_socket:
+        front_end = SocketFrontEnd(server)
+        front_end.start()
+    clients = []
+    bot_names = {}
+    for i, bot in enumerate(bots):
+        name = '%d (%s)' % (i, bot.name)
+        bot_names[name] = bot.name
+        if use_socket:
+            clients.append(SocketClient(front_end.server_address, name))
+        else:
+            clients.append(Client(server, name))
+    barrier = RoundBarrier(len(bots))
+    threads = [threading.Thread(target=bot_loop,
+                                args=(bot, client, path, i, rounds, barrier,
+                                      max_executes))
+               for i, (bot, client) in enumerate(zip(bots, clients))]
+    server.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.stop()
+    if front_end is not None:
+        front_end.shutdown()
+        front_end.server_close()
+    metrics = server.metrics()
+    latency = {}
+    for client in clients:
+        for op, stats in client.latency.iteritems():
+            latency.setdefault(op, estimators.RunningStats()).merge(stats)
+    metrics['latency'] = latency
+    value = 100.0 * path.p_vec[-1]
+    profits = {market_fact.name:market_maker.user_account.profit(
+            {market_maker.id:value})}
+    for name, profit in server.profits(value).iteritems():
+        bot_name = bot_names[name]
+        profits[bot_name] = profits.get(bot_name, 0.0) + profit
+    return metrics, profits
+
+def report(metrics, profits):
+    print '%d requests in %1.2fs: %1.0f requests/s, %1.0f orders/s' % (
+        sum(metrics['served'].values()), metrics['elapsed'],
+        metrics['requests_per_second'], metrics['orders_per_second'])
+    print '%-12s %10s %14s %14s' % ('op', 'requests', 'mean latency',
+                                    'max latency')
+    for op, stats in sorted(metrics['latency'].iteritems()):
+        print '%-12s %10d %11.1f us %11.1f us' % (
+            op, stats.count, stats.mean * 1e6, stats.max * 1e6)
+    for name, profit in sorted(profits.iteritems()):
+        print '%s profit: %1.2f' % (name, profit)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bots', type=int, default=40,
+                        help='bots from other_bots, 4 fundamentals to 1 '
+                        'technical')
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--lmsr-b', type=float, default=250)
+    parser.add_argument('--socket', action='store_true',
+                        help='connect over a local TCP socket')
+    parser.add_argument('--max-executes', type=int, default=50,
+                        help='executes per bot per round')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+    technical = args.bots // 5
+    bots = other_bots.get_bots(args.bots - technical, technical)
+    report(*load_test(bots, args.rounds, args.lmsr_b, args.socket,
+                      args.seed, args.max_executes))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,24 +1,55 @@
 import math
+import numpy
 
-def hansonPriceCheck(transaction, qtyToBuySell, qtyOutstanding, maxLoss):
+def hansonCost(q1, q2, maxLoss):
+    '''maxLoss * log(exp(q1/maxLoss) + exp(q2/maxLoss)), in log-sum-exp
+    form so it does not overflow for large quantities.'''
+    return q2 + maxLoss * _log1pexp((q1 - q2) / maxLoss)
+
+def hansonQuote(transaction, qtyToBuySell, qtyOutstanding, maxLoss,
+                costInit):
+    '''hansonPriceCheck given the cost function at the current
+    quantities outstanding. Also returns the cost function at the new
+    quantities, which becomes costInit once the trade is made.'''
     newq1 = qtyOutstanding
-    q2 = newq2 = 0
+    newq2 = 0
     maxLoss = float(maxLoss)
     if transaction == "buy":
         newq1 += qtyToBuySell
     elif transaction == "sell":
         newq1 -= qtyToBuySell
+    # Cost function and price at new quantities outstanding, sharing a
+    # single exp (hansonCost and _sigmoid inlined)
+    x = (newq1 - newq2) / maxLoss
+    if x > 0:
+        e = math.exp(-x)
+        cost_final = newq2 + maxLoss * (x + math.log1p(e))
+        currentPrice = 100.0 / (1.0 + e)
+    else:
+        e = math.exp(x)
+        cost_final = newq2 + maxLoss * math.log1p(e)
+        currentPrice = 100.0 * e / (1.0 + e)
+    costToUser = (cost_final - costInit) * 100
+    return (abs(costToUser), newq1, currentPrice, cost_final)
+
+def hansonPriceCurve(transaction, qtysToBuySell, qtyOutstanding, maxLoss,
+                     costInit):
+    '''Total cost to the user of each quantity in the NumPy array
+    qtysToBuySell, given the cost function at the current quantities.'''
+    maxLoss = float(maxLoss)
+    if transaction == "buy":
+        newq1 = qtyOutstanding + qtysToBuySell
+    else:
+        newq1 = qtyOutstanding - qtysToBuySell
+    cost_final = maxLoss * numpy.logaddexp(newq1 / maxLoss, 0.0)
+    return numpy.abs(cost_final - costInit) * 100
+
+def hansonPriceCheck(transaction, qtyToBuySell, qtyOutstanding, maxLoss):
+    maxLoss = float(maxLoss)
     # Cost function evaluated at current quantities outstanding
-    cost_init = maxLoss * math.log(
-        math.exp(qtyOutstanding/maxLoss) + math.exp(q2/maxLoss))
-    # Cost function evaluated at new quantities outstanding
-    cost_final = maxLoss * math.log(
-        math.exp(newq1/maxLoss) + math.exp(newq2/maxLoss))
-    costToUser = (cost_final - cost_init) * 100
-    currentPrice = (math.exp(newq1/maxLoss)
-                    / (math.exp(newq1/maxLoss)
-                       + math.exp(newq2/maxLoss))) * 100
-    return (abs(costToUser), newq1, currentPrice)
+    cost_init = hansonCost(qtyOutstanding, 0, maxLoss)
+    return hansonQuote(transaction, qtyToBuySell, qtyOutstanding, maxLoss,
+                       cost_init)[:3]
 
 def prediction_limit(val):
     if val > 100:
@@ -26,3 +57,106 @@ def prediction_limit(val):
     if val < 0:
         return float(0)
     return val
+
+def _log1pexp(x):
+    # log(1 + exp(x)) without overflow
+    if x > 0:
+        return x + math.log1p(math.exp(-x))
+    return math.log1p(math.exp(x))
+
+def _sigmoid(x):
+    if x >= 0:
+        return 1.0 / (1.0 + math.exp(-x))
+    return math.exp(x) / (1.0 + math.exp(x))
+
+def hansonQuantityForPrice(transaction, pricePerShare, qtyOutstanding,
+                           maxLoss):
+    '''Largest real quantity whose average price per share is at most
+    (buy) or at least (sell) pricePerShare; inf if there is no limit.'''
+    maxLoss = float(maxLoss)
+    if transaction == "sell":
+        # Selling x at q costs the complement of buying x at -q.
+        return hansonQuantityForPrice("buy", 100.0 - pricePerShare,
+                                      -qtyOutstanding, maxLoss)
+    target = pricePerShare / 100.0
+    if target >= 1.0:
+        return float('inf')
+    if _sigmoid(qtyOutstanding / maxLoss) >= target:
+        return 0.0
+    # gap(x) = cost of buying x - target * x is convex with gap(0) = 0 and
+    # a single positive root; Newton from the right converges to it
+    # monotonically.
+    base = _log1pexp(qtyOutstanding / maxLoss)
+    def gap(x):
+        return (maxLoss * (_log1pexp((qtyOutstanding + x) / maxLoss) - base)
+                - target * x)
+    quantity = max(maxLoss, 2.0 * hansonQuantityForMu(
+            transaction, pricePerShare, qtyOutstanding, maxLoss))
+    while gap(quantity) <= 0:
+        quantity *= 2.0
+    for _ in range(100):
+        slope = _sigmoid((qtyOutstanding + quantity) / maxLoss) - target
+        step = gap(quantity) / slope
+        quantity -= step
+        if step <= 1e-12 * max(1.0, quantity):
+            break
+    return quantity
+
+def hansonQuantityForMu(transaction, newMu, qtyOutstanding, maxLoss):
+    '''Quantity to buy (sell) that moves the market price to newMu; 0 if
+    the price is already past it and inf if it can never get there.'''
+    maxLoss = float(maxLoss)
+    target = newMu / 100.0
+    if transaction == "buy":
+        if target >= 1.0:
+            return float('inf')
+        if target <= 0.0:
+            return 0.0
+    else:
+        if target <= 0.0:
+            return float('inf')
+        if target >= 1.0:
+            return 0.0
+    qtyTarget = maxLoss * math.log(target / (1.0 - target))
+    if transaction == "buy":
+        return max(0.0, qtyTarget - qtyOutstanding)
+    return max(0.0, qtyOutstanding - qtyTarget)
+
+# n-outcome LMSR. quantities is an array whose last axis holds one
+# market's outcomes, so a whole book of markets is priced in one call.
+
+def hansonMultiCost(quantities, maxLoss):
+    '''maxLoss * log(sum(exp(quantities / maxLoss))) over the last axis.'''
+    maxLoss = float(maxLoss)
+    scaled = numpy.asarray(quantities, dtype=float) / maxLoss
+    top = scaled.max(axis=-1)
+    return maxLoss * (top + numpy.log(
+            numpy.exp(scaled - top[..., numpy.newaxis]).sum(axis=-1)))
+
+def hansonMultiPrices(quantities, maxLoss):
+    '''Price of every outcome, between 0 and 1 (the softmax).'''
+    scaled = numpy.asarray(quantities, dtype=float) / float(maxLoss)
+    e = numpy.exp(scaled - scaled.max(axis=-1)[..., numpy.newaxis])
+    return e / e.sum(axis=-1)[..., numpy.newaxis]
+
+def hansonMultiState(quantities, maxLoss):
+    '''(cost, prices, rest) in one pass: hansonMultiCost,
+    hansonMultiPrices and, for every outcome, the cost function of the
+    other outcomes of its market, maxLoss * log(sum over j != k of
+    exp(q_j / maxLoss)). Trading outcome k at quantity q_k costs the same
+    as trading a binary market at q_k minus its rest, so the binary
+    functions above price one outcome of an n-outcome market. rest comes
+    from running log-sum-exps from both ends, without subtracting
+    anything.'''
+    maxLoss = float(maxLoss)
+    scaled = numpy.asarray(quantities, dtype=float) / maxLoss
+    before = numpy.logaddexp.accumulate(scaled, axis=-1)
+    after = numpy.logaddexp.accumulate(scaled[..., ::-1],
+                                       axis=-1)[..., ::-1]
+    total = before[..., -1:]
+    prices = numpy.exp(scaled - total)
+    rest = numpy.empty_like(scaled)
+    rest[..., 0] = after[..., 1]
+    rest[..., -1] = before[..., -2]
+    rest[..., 1:-1] = numpy.logaddexp(before[..., :-2], after[..., 2:])
+    return maxLoss * total[..., 0], prices, maxLoss * rest
@@ -1,8 +1,8 @@
+import estimators
 import other_bots
 import traders
 import run_experiments
 import plot_simulation
-import statsmodels.stats.proportion as statistics
 
 
 class MyBot(traders.Trader):
@@ -10,8 +10,12 @@ class MyBot(traders.Trader):
 
     def simulation_params(self, timesteps,
                           possible_jump_locations,
-                          single_jump_probability):
-        """Receive information about the simulation."""
+                          single_jump_probability,
+                          jump_detection='cusum', window_length=20,
+                          sigma=20, cusum_threshold=6.0, belief_blend=0.5,
+                          riskiness=1):
+        """Receive information about the simulation. The keyword
+        arguments are tuning knobs, see MyBot(**params)."""
         # Number of trading opportunities
         self.timesteps = timesteps
         # A list of timesteps when there could be a jump
@@ -20,15 +24,29 @@ class MyBot(traders.Trader):
         # actually jumping at that point. Jumps are normally
         # distributed with mean 0 and standard deviation 0.2.
         self.single_jump_probability = single_jump_probability
-        # A place to store the information we get
-        self.information = []
 
         # the bot's belief of p_i (starting in the middle, which is 50)
         self.belief = 50.0
+        # weight of our own estimate against the market's belief
+        self.belief_blend = belief_blend
+        # scales the quantity our confidence allows
+        self.riskiness = riskiness
         # the market maker's list of beliefs.
         self.market_beliefs = []
+        # how to detect a jump: 'cusum' runs an online changepoint test
+        # on every draw, 'window' checks whether the sliding average
+        # leaves the belief +- sigma band
+        self.jump_detection = jump_detection
         # length of the sliding window to check for a jump
-        self.window_length = 20
+        self.window_length = window_length
+        self.sigma = sigma
+        # the cusum test needs a rough estimate of p_i first
+        self.min_trials = 10
+        self.detector = estimators.CusumDetector(shift=0.2,
+                                                 threshold=cusum_threshold)
+        # running counts of the information we get
+        self.estimator = estimators.BernoulliEstimator(
+            window_length=self.window_length - 1)
 
     def new_information(self, info, time):
         """Get information about the underlying market value.
@@ -38,18 +56,30 @@ class MyBot(traders.Trader):
         time: The current timestep for the experiment. It
           matches up with possible_jump_locations. It will
           be between 0 and self.timesteps - 1."""
-        self.information.append(info)
+        if (self.jump_detection == 'cusum'
+                and self.estimator.trials >= self.min_trials):
+            p_i_estimate = self.estimator.p()
+            self.estimator.update(info)
+            if self.detector.update(info, p_i_estimate):
+                # jump detected, keep only the information since the jump
+                self.estimator.reset(*self.detector.since)
+        else:
+            self.estimator.update(info)
 
     def trades_history(self, trades, time):
         """A list of everyone's trades, in the following format:
         [(execution_price, 'buy' or 'sell', quantity,
           previous_market_belief), ...]
-        Note that this isn't just new trades; it's all of them."""
+        Note that this isn't just new trades; it's all of them. To
+        get only the trades since the previous round, override
+        new_trades(trades, time) instead; traders.RollingWindow keeps
+        running statistics over the last few prices."""
         self.trades = trades
 
     def trading_opportunity(self, cash_callback, shares_callback,
                             check_callback, execute_callback,
-                            market_belief):
+                            market_belief, quantity_callback=None,
+                            check_many_callback=None):
         """Called when the bot has an opportunity to trade.
         
         cash_callback(): How much cash the bot has right now.
@@ -59,78 +89,87 @@ class MyBot(traders.Trader):
         execute_callback(buysell, quantity): Buy or sell the given
           quantity of shares.
         market_belief: The market maker's current belief.
+        quantity_callback(buysell, price, marginal=False): Returns the
+          largest whole quantity whose per-share price is at most
+          (buy) or at least (sell) price, or with marginal=True, that
+          moves the market belief no further than price. Returns inf
+          if there is no limit.
+        check_many_callback(buysell, quantities): Like check_callback
+          for a whole list or array of quantities at once; returns a
+          NumPy array of per-share prices.
+
+        quantity_callback and check_many_callback are only passed to
+        bots whose trading_opportunity names them, and a driver may not
+        have them at all. Without quantity_callback the bot bisects
+        with check_callback instead, see traders.search_quantity.
 
         Note that a bot can always buy and sell: the bot will borrow
         shares or cash automatically.
         """
         # keep track of the market beliefs
         self.market_beliefs.append(market_belief)
-        time_step = len(self.information)
 
-        # number of successes
-        count = sum(self.information)
-        # total number of trials ( current timestep )
-        nobs = time_step
+        # total number of trials (since the last jump)
+        nobs = self.estimator.trials
         #  asymptotic normal approximation
         # 95% confident p_i is between ci_low and ci_high (covers 1-alpha)
-        ci_low, ci_upp = statistics.proportion_confint(count, nobs, alpha=0.05, method='normal')
+        ci_low, ci_upp = self.estimator.interval(method='normal')
 
-        # average of market's belief and my p_i estimate
-        p_i_estimate = float(count) / float(time_step)
-        self.belief = (100 * p_i_estimate + market_belief) / 2
+        # weighted average of market's belief and my p_i estimate
+        p_i_estimate = self.estimator.p()
+        self.belief = (self.belief_blend * 100 * p_i_estimate
+                       + (1 - self.belief_blend) * market_belief)
         # self.belief = (ci_upp * 100 + ci_low * 100 + market_belief) / 3
 
         # detect jump
-        if time_step > self.window_length:
+        if self.jump_detection == 'window' and nobs > self.window_length:
             # normal distribution centered at p_i with standard deviation of 0.2
             mu = self.belief
-            sigma = 20
 
-            jump_low = mu - 1 * sigma
-            jump_upp = mu + 1 * sigma
+            jump_low = mu - 1 * self.sigma
+            jump_upp = mu + 1 * self.sigma
 
-            last_elts = -self.window_length + 1
-            sliding_average = sum(self.information[last_elts:]) / float(len(self.information[last_elts:]))
-            sliding_average *= 100
+            sliding_average = self.estimator.window_p() * 100
             if sliding_average < jump_low:
                 # jump detected, reset our information as it is no longer valid
-                self.information = []
+                self.estimator.reset()
             elif sliding_average > jump_upp:
                 # jump detected, reset our information as it is no longer valid
-                self.information = []
+                self.estimator.reset()
 
         best_buy_qty, expected_buy_profit = self.maximize_buysell_profit_qty('buy', self.belief, ci_low, ci_upp,
-                                                                             check_callback)
+                                                                             check_callback, quantity_callback,
+                                                                             self.riskiness)
         best_sell_qty, expected_sell_profit = self.maximize_buysell_profit_qty('sell', self.belief, ci_low, ci_upp,
-                                                                               check_callback)
+                                                                               check_callback, quantity_callback,
+                                                                               self.riskiness)
 
         # if there is a profitable action, execute it
         if expected_buy_profit > expected_sell_profit and best_buy_qty > 0:
-            # print 'buying',best_buy_qty, self.belief, time_step
+            # print 'buying',best_buy_qty, self.belief, nobs
             execute_callback('buy', best_buy_qty)
         elif expected_buy_profit <= expected_sell_profit and best_sell_qty > 0:
-            # print 'buying', best_sell_qty, self.belief, time_step
+            # print 'buying', best_sell_qty, self.belief, nobs
             execute_callback('sell', best_sell_qty)
 
     @staticmethod
-    def maximize_buysell_profit_qty(action, p_i_estimate, ci_low, ci_upp, check_callback):
+    def maximize_buysell_profit_qty(action, p_i_estimate, ci_low, ci_upp, check_callback, quantity_callback,
+                                    riskiness=1):
         """ maximize the profit, while minimizing risk
         returns the quantity that maximizes the expected profit
         """
         ci_range = ci_upp - ci_low
         if ci_range > 0:
             confidence = max(0, int(1 / ci_range ** 2) - 1)
-            riskiness = 1
             max_quantity = int(confidence * riskiness)
-            quantity = max_quantity
-            while quantity > 0:
-                if action is 'buy' and p_i_estimate > check_callback(action, quantity):
-                    expected_profit = quantity * ((p_i_estimate * 100) - check_callback(action, quantity))
-                    return quantity, expected_profit
-                elif action is 'sell' and p_i_estimate < check_callback(action, quantity):
-                    expected_profit = quantity * ((p_i_estimate * 100) - check_callback(action, quantity))
-                    return quantity, expected_profit
-                quantity -= 1
+            # largest quantity whose price is still on our side of the estimate
+            if quantity_callback is None:
+                quantity = traders.search_quantity(check_callback, action, p_i_estimate, max_quantity)
+            else:
+                quantity = min(max_quantity, quantity_callback(action, p_i_estimate))
+            if quantity > 0:
+                expected_profit = quantity * ((p_i_estimate * 100) - check_callback(action, quantity))
+                return quantity, expected_profit
             return 0, 0
         else:
             return 0, 0
@@ -156,7 +195,9 @@ def main():
 #   timesteps=100, lmsr_b=150
 
 # Extra parameters to run_experiments.run:
-#   timesteps=100, num_processes=2, simulations=2000, lmsr_b=150
+#   timesteps=100, num_processes=2, simulations=2000, lmsr_b=150,
+#   seed=None, chunksize=50, path_bank=None, keep_profits=False,
+#   profile=False, show_progress=None, snapshot_file=None
 
 # Descriptions of extra parameters:
 # timesteps: The number of trading rounds in each simulation.
@@ -165,6 +206,18 @@ def main():
 # num_processes: In general, set this to the number of cores on your
 #                  machine to get maximum performance.
 # simulations: The number of simulations to run.
+# seed: Makes run_experiments.run reproducible. Each worker builds
+#         fresh bots from their class and keyword arguments, such as
+#         MyBot(window_length=30), so settings made on the objects in
+#         bots after creating them are lost.
+# chunksize: Simulations handed to a worker at a time.
+# keep_profits: Also return every simulation's profits, not just the
+#                 running statistics.
+# profile: Print a table of call counts and wall time per bot type.
+# show_progress: Show simulations done, simulations per second and the
+#                  ETA on stderr. By default on when it is a terminal.
+# snapshot_file: Also write the progress to this file as JSON every
+#                  second, for watching a long run from elsewhere.
 
 if __name__ == '__main__':  # If this file is run directly
     main()
@@ -38,7 +38,8 @@ class MovingAverageBot(traders.Trader):
 
     def trading_opportunity(self, cash_callback, shares_callback,
                             check_callback, execute_callback,
-                            market_belief):
+                            market_belief, quantity_callback=None,
+                            check_many_callback=None):
         current_belief = (self.belief + market_belief) / 2.0
         current_belief = max(min(current_belief, 99.0), 1.0)
         bought_once = False
@@ -62,22 +63,14 @@ class MovingAverageBot(traders.Trader):
                 if block_size < self.min_block_size:
                     block_size = self.min_block_size
 
-def optimize_shares(objective, feasible, initial_price):
-    price = initial_price
-    shares = 1
-    cancel = True
-    previous_objective = 0.0
-    while True:
-        feas, used_cancel = feasible(shares)
-        if not feas:
-            cancel = used_cancel
-            break
-        current_objective = objective(shares)
-        if current_objective <= previous_objective:
-            break
-        previous_objective = current_objective
-        shares += 1
-    return shares - 1, cancel
+MAX_SHARES = 199
+
+def max_shares(buysell, limit, check_callback, quantity_callback):
+    '''Shares, at most MAX_SHARES, tradable within limit.'''
+    if quantity_callback is None:
+        return traders.search_quantity(check_callback, buysell, limit,
+                                       MAX_SHARES)
+    return min(MAX_SHARES, quantity_callback(buysell, limit))
 
 def execute_max(shares, execute):
     price_per_share = None
@@ -100,23 +93,21 @@ class ShortLongTechnical(traders.Trader):
         self.max_short_exceed = max_short_exceed
         self.margin = margin
         self.state = None
-        self.execution_prices = None
+        self.short_window = traders.RollingWindow(short_length)
+        self.long_window = traders.RollingWindow(long_length)
         self.trade = False
         self.long_average = None
         self.short_average = None
-    
-    def trades_history(self, trades, time):
-        def mean(lst):
-            return sum(lst) / float(len(lst))
-        execution_prices = [pr[0] for pr in trades]
-        self.execution_prices = execution_prices
-        if len(self.execution_prices) < self.long_length:
+
+    def new_trades(self, trades, time):
+        for pr in trades:
+            self.short_window.push(pr[0])
+            self.long_window.push(pr[0])
+        if not self.long_window.full():
             self.trade = False
             return
-        self.short_average = mean(
-            self.execution_prices[-self.short_length:])
-        self.long_average = mean(
-            self.execution_prices[-self.long_length:])
+        self.short_average = self.short_window.mean()
+        self.long_average = self.long_window.mean()
         if self.state is None:
             self.trade = False
             if self.short_average > self.long_average:
@@ -135,7 +126,9 @@ class ShortLongTechnical(traders.Trader):
                 self.trade = 'buy'
 
     def trading_opportunity(self, cash_callback, shares_callback,
-                            check_callback, execute_callback, mu):
+                            check_callback, execute_callback, mu,
+                            quantity_callback=None,
+                            check_many_callback=None):
         if self.trade == False:
             return
 
@@ -144,38 +137,18 @@ class ShortLongTechnical(traders.Trader):
         execute_sell = lambda amount: execute_callback(
             'sell', amount)
         if self.trade == 'sell':
-            def objective(amount):
-                execution_price = check_callback('sell', amount)
-                if (execution_price
-                    >= self.long_average - self.max_long_exceed
-                    and execution_price
-                    >= self.short_average - self.max_short_exceed
-                    and execution_price < 100.0
-                    and execution_price > 0.0):
-                    return amount
-                else:
-                    return -1
-            feasible = lambda amount: (amount < 200, False)
-            shares, cancel = optimize_shares(
-                objective, feasible, mu)
+            limit = max(self.long_average - self.max_long_exceed,
+                        self.short_average - self.max_short_exceed)
+            shares = max_shares('sell', limit, check_callback,
+                                quantity_callback)
             if shares > 0:
                 price_per_share, shares = execute_max(
                     shares, execute_sell)
         elif self.trade == 'buy':
-            def objective(amount):
-                execution_price = check_callback('buy', amount)
-                if (execution_price
-                    <= self.long_average + self.max_long_exceed
-                    and execution_price
-                    <= self.short_average + self.max_short_exceed
-                    and execution_price < 100.0
-                    and execution_price > 0.0):
-                    return amount
-                else:
-                    return -1
-            feasible = lambda amount: (amount < 200, False)
-            shares, cancel = optimize_shares(
-                objective, feasible, mu)
+            limit = min(self.long_average + self.max_long_exceed,
+                        self.short_average + self.max_short_exceed)
+            shares = max_shares('buy', limit, check_callback,
+                                quantity_callback)
             if shares > 0:
                 price_per_share, shares = execute_max(
                     shares, execute_buy)
@@ -189,49 +162,38 @@ class RangeTechnical(traders.Trader):
         self.window = window
         self.margin = margin
         self.max_exceed = max_exceed
-        self.execution_prices = None
-    
-    def trades_history(self, trades, time):
-        execution_prices = [pr[0] for pr in trades]
-        self.execution_prices = execution_prices
+        # The window holds the trades before the latest one.
+        self.window_trades = traders.RollingWindow(window)
+        self.last_price = None
+
+    def new_trades(self, trades, time):
+        for pr in trades:
+            if self.last_price is not None:
+                self.window_trades.push(self.last_price)
+            self.last_price = pr[0]
 
     def trading_opportunity(self, cash_callback, shares_callback,
-                            check_callback, execute_callback, mu):
-        if len(self.execution_prices) < self.window + 1:
+                            check_callback, execute_callback, mu,
+                            quantity_callback=None,
+                            check_many_callback=None):
+        if not self.window_trades.full():
             return
-        window_trades = self.execution_prices[-(self.window + 1):-1]
-        min_price = min(window_trades)
-        max_price = max(window_trades)
+        min_price = self.window_trades.min()
+        max_price = self.window_trades.max()
         execute_buy = lambda amount: execute_callback(
             'buy', amount)
         execute_sell = lambda amount: execute_callback(
             'sell', amount)
-        if self.execution_prices[-1] > max_price + max_price * self.margin:
-            def objective(amount):
-                price = check_callback('buy', amount)
-                if (price <= max_price + self.max_exceed
-                    and price > 0.0 and price < 100.0):
-                    return amount
-                else:
-                    return -1
-            feasible = lambda amount: (amount < 200, False)
-            shares, cancel = optimize_shares(
-                objective, feasible, mu)
+        if self.last_price > max_price + max_price * self.margin:
+            shares = max_shares('buy', max_price + self.max_exceed,
+                                check_callback, quantity_callback)
             if shares > 0:
                 price_per_share, shares = execute_max(
                     shares, execute_buy)
-        elif self.execution_prices[-1] < (
+        elif self.last_price < (
             min_price - min_price * self.margin):
-            def objective(amount):
-                price = check_callback('sell', amount)
-                if (price >= min_price - self.max_exceed
-                    and price < 100.0 and price > 0.0):
-                    return amount
-                else:
-                    return -1
-            feasible = lambda amount: (amount < 200, False)
-            shares, cancel = optimize_shares(
-                objective, feasible, mu)
+            shares = max_shares('sell', min_price - self.max_exceed,
+                                check_callback, quantity_callback)
             if shares > 0:
                 price_per_share, shares = execute_max(
                     shares, execute_sell)
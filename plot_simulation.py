@@ -23,4 +23,6 @@ def run(traders, timesteps=100, lmsr_b=150):
                 ls='--', color='r')
     pyplot.ylim((0, 100))
     print sim_obj.profits_by_user()
+    print 'quote cache: %d hits, %d misses' % (sim_obj.quote_hits,
+                                                sim_obj.quote_misses)
     pyplot.show()
@@ -1,26 +1,59 @@
 import abc
-import copy
+import math
+import numpy
 import marketmaker
 
-class MarketMaker(object):
+class Slotted(object):
+    '''Base of classes with __slots__, which pickle with every protocol
+    through a dict of the slots that are set.'''
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+class MarketMaker(Slotted):
+    __slots__ = ()
+
     @abc.abstractmethod
-    def execute(self, buysell, quantity, user, cancel=False):
+    def execute(self, buysell, quantity, user, cancel=False, quote=None):
         pass
 
     @abc.abstractmethod
     def price_check(self, buysell, quantity):
         pass
 
+    def quote(self, buysell, quantity):
+        '''Returns (price_per_share, state). Passing the quote back to
+        execute lets a market maker commit the trade without pricing it
+        again.'''
+        return self.price_check(buysell, quantity), None
+
+    def price_check_many(self, buysell, quantities):
+        return numpy.array([self.price_check(buysell, quantity)
+                            for quantity in quantities])
+
     def _price_per_share(self, quantity, total_cost):
         return marketmaker.prediction_limit(
             float(total_cost) / float(quantity))
 
-class User(object):
+class User(Slotted):
+    __slots__ = ('cash', 'initial_cash', 'shares', 'initial_shares', 'name')
+
     def __init__(self, cash, initial_shares, name=None):
         self.cash = float(cash)
         self.initial_cash = self.cash
-        self.shares = copy.deepcopy(initial_shares)
-        self.initial_shares = copy.deepcopy(initial_shares)
+        # share counts are numbers, a shallow copy is enough
+        self.shares = dict(initial_shares)
+        self.initial_shares = dict(initial_shares)
         self.name = name
 
     def change_cash(self, amount):
@@ -39,6 +72,10 @@ class User(object):
         return profit
 
 class LMSR(MarketMaker):
+    __slots__ = ('max_loss', 'quantity_outstanding', 'mu', 'user_account',
+                 'cancels', 'id', '_state_quantity', '_cost', '_quotes',
+                 'quote_hits', 'quote_misses')
+
     def __init__(self, max_loss, quantity_outstanding=0, mu=50.0,
                  user_account=None):
         self.max_loss = float(max_loss)
@@ -50,34 +87,262 @@ class LMSR(MarketMaker):
             self.user_account = User(0, {})
         self.cancels = []
         self.id = hash(self)
+        # Cost function at quantity_outstanding, kept up to date by
+        # execute so a quote only evaluates the cost after the trade,
+        # and the quotes already made at quantity_outstanding.
+        self._state_quantity = None
+        self._cost = None
+        self._quotes = {}
+        self.quote_hits = 0
+        self.quote_misses = 0
+
+    def _sync_state(self):
+        self._cost = marketmaker.hansonCost(
+            self.quantity_outstanding, 0, self.max_loss)
+        self._quotes.clear()
+        self._state_quantity = self.quantity_outstanding
+
+    def quote(self, buysell, quantity):
+        if self._state_quantity != self.quantity_outstanding:
+            self._sync_state()
+        key = (buysell, quantity)
+        cached = self._quotes.get(key)
+        if cached is not None:
+            self.quote_hits += 1
+            return cached
+        self.quote_misses += 1
+        (offered_price, new_quantity_outstanding, new_mu,
+         new_cost) = marketmaker.hansonQuote(
+            buysell, quantity, self.quantity_outstanding, self.max_loss,
+            self._cost)
+        ret = (self._price_per_share(quantity, offered_price),
+               (self.quantity_outstanding, new_quantity_outstanding,
+                new_mu, new_cost))
+        self._quotes[key] = ret
+        return ret
+
+    def price_check(self, buysell, quantity):
+        price_per_share, _ = self.quote(buysell, quantity)
+        return price_per_share
+
+    def price_check_many(self, buysell, quantities):
+        '''price_check for every entry of quantities, as a NumPy array.'''
+        if self._state_quantity != self.quantity_outstanding:
+            self._sync_state()
+        quantities = numpy.asarray(quantities, dtype=float)
+        offered_prices = marketmaker.hansonPriceCurve(
+            buysell, quantities, self.quantity_outstanding, self.max_loss,
+            self._cost)
+        return numpy.clip(offered_prices / quantities, 0.0, 100.0)
+
+    def max_quantity(self, buysell, price, marginal=False):
+        '''Largest whole quantity whose price_check is at most (buy) or
+        at least (sell) price, or with marginal, that moves mu no further
+        than price. inf if every quantity qualifies.'''
+        return _max_quantity(self, self.quantity_outstanding,
+                             self.max_loss, buysell, price, marginal)
+
+    def execute(self, buysell, quantity, user, cancel=False, quote=None):
+        if cancel:
+            return
+        # A quote is only good for the state it was made in.
+        if quote is None or quote[1][0] != self.quantity_outstanding:
+            quote = self.quote(buysell, quantity)
+        offered_price, (_, self.quantity_outstanding, self.mu,
+                        self._cost) = quote
+        self._state_quantity = self.quantity_outstanding
+        self._quotes.clear()
+        return offered_price
+
+def _max_quantity(market_maker, quantity_outstanding, max_loss, buysell,
+                  price, marginal):
+    # LMSR.max_quantity for a binary market at quantity_outstanding
+    if marginal:
+        quantity = marketmaker.hansonQuantityForMu(
+            buysell, price, quantity_outstanding, max_loss)
+        if math.isinf(quantity):
+            return quantity
+        return int(math.floor(quantity))
+    quantity = marketmaker.hansonQuantityForPrice(
+        buysell, price, quantity_outstanding, max_loss)
+    if math.isinf(quantity):
+        return quantity
+    # Snap the real root onto the quotes execute will actually use.
+    if buysell == 'buy':
+        within = lambda qty: market_maker.price_check(buysell, qty) <= price
+    else:
+        within = lambda qty: market_maker.price_check(buysell, qty) >= price
+    quantity = int(math.floor(quantity))
+    while quantity > 0 and not within(quantity):
+        quantity -= 1
+    while within(quantity + 1):
+        quantity += 1
+    return quantity
+
+class LMSRBook(object):
+    '''`markets` independent LMSR markets with `outcomes` outcomes each,
+    sharing max_loss. The quantities outstanding are one markets x
+    outcomes array; the cost, prices and the rest (see
+    marketmaker.hansonMultiState) of a market are recomputed with numpy
+    whenever it trades, so nothing is done per outcome in Python. Traders
+    trade single outcomes through contract(market, outcome), which works
+    like a binary LMSR.'''
+    def __init__(self, max_loss, markets, outcomes, user_account=None):
+        assert outcomes >= 2
+        self.max_loss = float(max_loss)
+        self.markets = markets
+        self.outcomes = outcomes
+        self.quantities = numpy.zeros((markets, outcomes))
+        # cash taken in by each market, for profits()
+        self.cash = numpy.zeros(markets)
+        # bumped when a market trades, quotes are only good for the
+        # version they were made at
+        self.versions = numpy.zeros(markets, dtype=numpy.int64)
+        if user_account:
+            self.user_account = user_account
+        else:
+            self.user_account = User(0, {})
+        self.id = hash(self)
+        self.contracts = {}
+        self.cost = numpy.empty(markets)
+        self.prices = numpy.empty_like(self.quantities)
+        self.rest = numpy.empty_like(self.quantities)
+        self._refresh(slice(None))
+
+    def _refresh(self, markets):
+        (self.cost[markets], self.prices[markets],
+         self.rest[markets]) = marketmaker.hansonMultiState(
+            self.quantities[markets], self.max_loss)
+
+    def contract(self, market, outcome):
+        key = (market, outcome)
+        if key not in self.contracts:
+            self.contracts[key] = Contract(self, market, outcome)
+        return self.contracts[key]
+
+    def contract_id(self, market, outcome):
+        return (self.id, market, outcome)
+
+    def trade(self, market, outcome, quantity, cash):
+        '''Add quantity (negative to sell) to an outcome, for cash.'''
+        self.quantities[market, outcome] += quantity
+        self.cash[market] += cash
+        self.versions[market] += 1
+        self._refresh(market)
+
+    def portfolio_cost(self, quantities):
+        '''Cost of buying (negative: selling) a markets x outcomes array
+        of shares, per market, priced 0 to 100 like a quote.'''
+        return 100 * (marketmaker.hansonMultiCost(
+                self.quantities + quantities, self.max_loss) - self.cost)
+
+    def liquidation(self, values):
+        '''{contract id:value} for a markets x outcomes array of the
+        value of each outcome's share, for User.profit.'''
+        return dict(((self.id, market, outcome), value)
+                    for (market, outcome), value
+                    in numpy.ndenumerate(values))
+
+    def profits(self, values):
+        '''Market maker profit of each market when each outcome's share
+        is worth values, a markets x outcomes array.'''
+        return self.cash - (self.quantities * values).sum(axis=1)
+
+class Contract(MarketMaker):
+    '''One outcome of an LMSRBook market, quoted and executed like a
+    binary LMSR at quantity q_k - rest_k.'''
+    __slots__ = ('book', 'market', 'outcome', 'id', 'cancels',
+                 'user_account', '_version', '_quotes', 'quote_hits',
+                 'quote_misses')
+
+    def __init__(self, book, market, outcome):
+        self.book = book
+        self.market = market
+        self.outcome = outcome
+        self.id = book.contract_id(market, outcome)
+        self.cancels = []
+        self.user_account = book.user_account
+        self._version = None
+        self._quotes = {}
+        self.quote_hits = 0
+        self.quote_misses = 0
+
+    @property
+    def max_loss(self):
+        return self.book.max_loss
+
+    @property
+    def quantity_outstanding(self):
+        book = self.book
+        return (book.quantities[self.market, self.outcome]
+                - book.rest[self.market, self.outcome])
 
-    def _get_update(self, buysell, quantity):
-        (offered_price, new_quantity_outstanding,
-         new_mu) = marketmaker.hansonPriceCheck(
-            transaction=buysell, qtyToBuySell=quantity,
-            qtyOutstanding=self.quantity_outstanding,
-            maxLoss=self.max_loss)
-        return (self._price_per_share(quantity, offered_price),
-                new_quantity_outstanding, new_mu)
+    @property
+    def mu(self):
+        return 100.0 * self.book.prices[self.market, self.outcome]
+
+    def quote(self, buysell, quantity):
+        version = self.book.versions[self.market]
+        if self._version != version:
+            self._quotes.clear()
+            self._version = version
+        key = (buysell, quantity)
+        cached = self._quotes.get(key)
+        if cached is not None:
+            self.quote_hits += 1
+            return cached
+        self.quote_misses += 1
+        quantity_outstanding = self.quantity_outstanding
+        offered_price = marketmaker.hansonQuote(
+            buysell, quantity, quantity_outstanding, self.book.max_loss,
+            marketmaker.hansonCost(quantity_outstanding, 0,
+                                   self.book.max_loss))[0]
+        ret = (self._price_per_share(quantity, offered_price), version)
+        self._quotes[key] = ret
+        return ret
 
     def price_check(self, buysell, quantity):
-        price_per_share, _, _ = self._get_update(
-            buysell, quantity)
+        price_per_share, _ = self.quote(buysell, quantity)
         return price_per_share
 
-    def execute(self, buysell, quantity, user, cancel=False):
+    def price_check_many(self, buysell, quantities):
+        quantity_outstanding = self.quantity_outstanding
+        quantities = numpy.asarray(quantities, dtype=float)
+        offered_prices = marketmaker.hansonPriceCurve(
+            buysell, quantities, quantity_outstanding, self.book.max_loss,
+            marketmaker.hansonCost(quantity_outstanding, 0,
+                                   self.book.max_loss))
+        return numpy.clip(offered_prices / quantities, 0.0, 100.0)
+
+    def max_quantity(self, buysell, price, marginal=False):
+        return _max_quantity(self, self.quantity_outstanding,
+                             self.book.max_loss, buysell, price, marginal)
+
+    def execute(self, buysell, quantity, user, cancel=False, quote=None):
         if cancel:
             return
-        (offered_price, self.quantity_outstanding,
-         self.mu) = self._get_update(buysell, quantity)
+        if quote is None or quote[1] != self.book.versions[self.market]:
+            quote = self.quote(buysell, quantity)
+        offered_price = quote[0]
+        if buysell == 'sell':
+            quantity = -quantity
+        self.book.trade(self.market, self.outcome, quantity,
+                        offered_price * quantity)
         return offered_price
 
 def check(buysell, quantity, stock_maker, user):
     return stock_maker.price_check(buysell, quantity)
 
+def check_many(buysell, quantities, stock_maker, user):
+    return stock_maker.price_check_many(buysell, quantities)
+
+def max_quantity(buysell, price, stock_maker, user, marginal=False):
+    return stock_maker.max_quantity(buysell, price, marginal)
+
 def execute(buysell, quantity, stock_maker, user):
     '''Executes a user's order if the market state is consistent'''
-    costPerShare = stock_maker.price_check(buysell, quantity)
+    quote = stock_maker.quote(buysell, quantity)
+    costPerShare = quote[0]
     offeredPrices = costPerShare * quantity
 
     if not 0.01 < costPerShare and buysell == 'sell':
@@ -101,7 +366,8 @@ def execute(buysell, quantity, stock_maker, user):
     if allow_trade == False:
         return None
 
-    executed_price = stock_maker.execute(buysell, quantity, user)
+    executed_price = stock_maker.execute(buysell, quantity, user,
+                                         quote=quote)
     # Preliminary processing
     if buysell=="sell":
         offeredPrices = offeredPrices * -1
@@ -128,3 +394,13 @@ class LMSRFactory(object):
         
     def make(self):
         return LMSR(self.b)
+
+class LMSRBookFactory(object):
+    def __init__(self, b, markets, outcomes):
+        self.b = b
+        self.markets = markets
+        self.outcomes = outcomes
+        self.name = 'LMSR book (b=%1.2f, %dx%d)' % (b, markets, outcomes)
+
+    def make(self):
+        return LMSRBook(self.b, self.markets, self.outcomes)
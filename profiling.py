@@ -0,0 +1,52 @@
+import timeit
+
+clock = timeit.default_timer
+
+class Profiler(object):
+    '''Call counts and wall time per trader name and event. Times of
+    trading_opportunity include the callbacks it makes.'''
+    EVENTS = ['new_information', 'trades_history', 'trading_opportunity',
+              'check', 'check_many', 'quantity', 'execute']
+
+    def __init__(self):
+        # (trader name, event) -> [calls, seconds]
+        self.totals = {}
+
+    def add(self, name, event, seconds):
+        entry = self.totals.get((name, event))
+        if entry is None:
+            self.totals[(name, event)] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    def timed(self, name, event, function):
+        '''function, counting its calls and time under (name, event).'''
+        def timed_function(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(name, event, clock() - start)
+        return timed_function
+
+    def merge(self, totals):
+        '''Add the totals of another Profiler, e.g. from a worker.'''
+        for key, (calls, seconds) in totals.iteritems():
+            entry = self.totals.setdefault(key, [0, 0.0])
+            entry[0] += calls
+            entry[1] += seconds
+
+    def report(self):
+        names = sorted(set(name for name, event in self.totals))
+        events = [event for event in self.EVENTS
+                  if any((name, event) in self.totals for name in names)]
+        print '%-20s' % 'trader' + ''.join(
+            '%22s' % event for event in events)
+        for name in names:
+            row = '%-20s' % name
+            for event in events:
+                calls, seconds = self.totals.get((name, event), (0, 0.0))
+                row += '%22s' % ('%d / %1.3fs' % (calls, seconds))
+            print row
+        print '(calls / wall time; trading_opportunity includes callbacks)'
@@ -0,0 +1,84 @@
+import json
+import os
+import sys
+import time
+
+class Progress(object):
+    '''Progress of a batch of simulations: completed and failed counts,
+    throughput overall and per worker, ETA and the running mean
+    profits. update() is called as each result comes back. At most
+    every `interval` seconds it rewrites a status line on stream (if
+    any) and the JSON snapshot file (if any).'''
+    def __init__(self, total, stream=sys.stderr, snapshot_file=None,
+                 interval=1.0):
+        self.total = total
+        self.stream = stream
+        self.snapshot_file = snapshot_file
+        self.interval = interval
+        self.start = time.time()
+        self.last_shown = None
+        self.completed = 0
+        self.failed = 0
+        # worker id -> simulations it finished
+        self.by_worker = {}
+        self.stats = {}
+
+    def update(self, failed, stats, worker=None):
+        '''One more simulation finished, by worker (any id, such as its
+        pid) if given. stats is {name: RunningStats}.'''
+        self.completed += 1
+        if worker is not None:
+            self.by_worker[worker] = self.by_worker.get(worker, 0) + 1
+        if failed:
+            self.failed += 1
+        self.stats = stats
+        now = time.time()
+        if self.last_shown is None or now - self.last_shown >= self.interval:
+            self.show(now)
+
+    def snapshot(self, now=None, done=False):
+        if now is None:
+            now = time.time()
+        elapsed = now - self.start
+        rate = self.completed / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.completed
+        return {'completed':self.completed, 'failed':self.failed,
+                'total':self.total, 'elapsed':elapsed,
+                'simulations_per_second':rate,
+                'per_worker':dict(
+                    (str(worker), count / elapsed if elapsed > 0 else 0.0)
+                    for worker, count in self.by_worker.iteritems()),
+                'eta':remaining / rate if rate > 0 else None,
+                'means':dict((name, stats.mean)
+                             for name, stats in self.stats.iteritems()
+                             if stats.count),
+                'updated':now, 'done':done}
+
+    def show(self, now=None, done=False):
+        snapshot = self.snapshot(now, done)
+        self.last_shown = snapshot['updated']
+        if self.stream is not None:
+            eta = snapshot['eta']
+            per_worker = snapshot['per_worker'].values()
+            if per_worker:
+                workers = ' (%d workers, %1.1f-%1.1f each)' % (
+                    len(per_worker), min(per_worker), max(per_worker))
+            else:
+                workers = ''
+            self.stream.write(
+                '\r%d/%d done, %d failed, %1.1f sims/s%s, ETA %s | %s' % (
+                    snapshot['completed'], self.total, snapshot['failed'],
+                    snapshot['simulations_per_second'], workers,
+                    '?' if eta is None else '%ds' % round(eta),
+                    ', '.join('%s %1.0f' % item
+                              for item in sorted(snapshot['means'].items()))))
+            if done:
+                self.stream.write('\n')
+            self.stream.flush()
+        if self.snapshot_file is not None:
+            with open(self.snapshot_file + '.tmp', 'w') as snapshot_file:
+                json.dump(snapshot, snapshot_file, sort_keys=True)
+            os.rename(self.snapshot_file + '.tmp', self.snapshot_file)
+
+    def finish(self):
+        self.show(done=True)
@@ -1,58 +1,645 @@
+import ctypes
+import ensemble
+import estimators
+import information
 import multiprocessing
 import numpy
+import os
 import prices
+import profiling
+import progress
+import random
 import simulation
 import sys
 
-def worker_process(sim_obj):
+def trader_spec(trader, **params):
+    """A small picklable description of a trader: the module and name
+    of its class, and its params (see traders.Trader) updated with
+    the keyword arguments."""
+    trader_params = dict(getattr(trader, 'params', {}))
+    trader_params.update(params)
+    return (trader.__class__.__module__, trader.__class__.__name__,
+            trader_params)
+
+def make_trader(spec):
+    module_name, class_name, kwargs = spec
+    __import__(module_name)
+    return getattr(sys.modules[module_name], class_name)(**kwargs)
+
+def as_trader_specs(trader_list):
+    """trader_list with its Trader instances replaced by their specs."""
+    return tuple(trader if isinstance(trader, tuple) else trader_spec(trader)
+                 for trader in trader_list)
+
+def trader_names(trader_specs):
+    return sorted(set(make_trader(spec).name for spec in trader_specs))
+
+def profit_columns(market_name, trader_specs):
+    """Names of the profits worker_process returns, in order."""
+    return [market_name] + trader_names(trader_specs)
+
+def new_stats(columns):
+    return dict((name, estimators.RunningStats()) for name in columns)
+
+def fold_profits(stats, columns, market_profit, trader_profits):
+    """Fold one simulation's profits, as worker_process returns them,
+    into {name: RunningStats}."""
+    for name, profit in zip(columns, (market_profit,) + tuple(trader_profits)):
+        stats[name].update(profit)
+
+def check_trader_specs(trader_specs, timesteps):
+    """Build every trader and give it its params, so a bad spec or a
+    mistyped knob raises here rather than in every simulation."""
+    for spec in trader_specs:
+        trader = make_trader(spec)
+        trader.simulation_params(timesteps, range(timesteps),
+                                 1.0 / timesteps,
+                                 **getattr(trader, 'params', {}))
+
+def master_seed(seed=None):
+    if seed is None:
+        return random.SystemRandom().getrandbits(32)
+    return seed
+
+def stream_seed(master, index):
+    """Seed of the index-th random stream under a master seed. It only
+    depends on the pair, not on which worker or chunk runs it."""
+    return (master << 32) | index
+
+def numpy_seed(seed):
+    """Split a non-negative integer into the 32 bit words
+    numpy.random.RandomState takes."""
+    words = [seed & 0xffffffff]
+    while seed >> 32:
+        seed >>= 32
+        words.append(seed & 0xffffffff)
+    return words
+
+def make_path(seed, timesteps, traders, antithetic=False):
+    return information.generate_path(
+        timesteps, traders, 1.0 / timesteps,
+        rng=numpy.random.RandomState(numpy_seed(seed)),
+        antithetic=antithetic)
+
+def make_path_bank(directory, simulations, timesteps, traders, seed=None):
+    """Save the information paths run(..., seed=seed) would draw for
+    `traders` traders. Passing the directory to run as path_bank then
+    replays them, so several experiments can share environments."""
+    master = master_seed(seed)
+    information.PathBank.from_paths(
+        [make_path(stream_seed(master, i), timesteps, traders)
+         for i in xrange(simulations)],
+        timesteps, traders).save(directory)
+
+_path_banks = {}
+
+def load_path_bank(directory):
+    """Memory-mapped bank, loaded once per process."""
+    if directory not in _path_banks:
+        _path_banks[directory] = information.PathBank.load(directory)
+    return _path_banks[directory]
+
+def simulation_specs(simulations, timesteps, marketmaker_fact,
+                     trader_specs, master, path_bank=None, start=0,
+                     profile=False):
+    """One (timesteps, market factory, trader specs, seed, path bank,
+    profile) tuple per simulation from start on, generated lazily so
+    nothing grows with simulations."""
+    for i in xrange(start, simulations):
+        yield (timesteps, marketmaker_fact, trader_specs,
+               stream_seed(master, i), path_bank, profile)
+
+def simulate_spec(spec, record=False):
+    """Run one simulation from its spec. Returns its index and the
+    Simulation, or None if it failed."""
+    (timesteps, marketmaker_fact, trader_specs, seed, path_bank,
+     profile) = spec
+    # the low word of the seed is the simulation's index
+    index = seed & 0xffffffff
     try:
+        if path_bank is None:
+            path = make_path(seed, timesteps, len(trader_specs))
+        else:
+            path = load_path_bank(path_bank).path(index)
+        sim_obj = simulation.Simulation(
+            timesteps, marketmaker_fact,
+            [make_trader(trader_spec) for trader_spec in trader_specs],
+            log_level='off', seed=seed, path=path, profile=profile,
+            record=record)
         sim_obj.simulate()
     except Exception, e:
         print >> sys.stderr, type(e), e.args
-        return (None, None)
+        return index, None
     assert len(sim_obj.log.beliefs) == len(sim_obj.p_vec)
-    return (sim_obj.market_fact.name, sim_obj.profits_by_user())
+    return index, sim_obj
 
-def run(trader_list, timesteps=100, num_processes=2, simulations=2000,
-        lmsr_b=150):
+def worker_process(spec):
+    """Run one simulation from its spec. Returns the simulation's index,
+    the market maker's profit, a tuple of profits ordered like
+    trader_names() and the profiler totals if profiling. The profits
+    are None on failure."""
+    marketmaker_fact = spec[1]
+    index, sim_obj = simulate_spec(spec)
+    if sim_obj is None:
+        return (index, None, None, None)
+    profits = sim_obj.profits_by_user()
+    market_profit = profits.pop(marketmaker_fact.name)
+    totals = sim_obj.profiler.totals if sim_obj.profiler else None
+    return (index, market_profit,
+            tuple(profits[name] for name in sorted(profits)), totals)
+
+def record_worker_process(spec):
+    index, sim_obj = simulate_spec(spec, record=True)
+    if sim_obj is None:
+        return index, None
+    return index, sim_obj.recording
+
+def make_scenario_bank(directory, trader_list, simulations, timesteps=100,
+                       lmsr_b=150, num_processes=2, seed=None, chunksize=10,
+                       path_bank=None):
+    """Run simulations like run and save what each one saw and did (see
+    simulation.Simulation's record) as an information.ScenarioBank in
+    directory, for run_replay. Returns the bank."""
+    master = master_seed(seed)
+    trader_specs = as_trader_specs(trader_list)
+    specs = simulation_specs(simulations, timesteps,
+                             prices.LMSRFactory(lmsr_b), trader_specs,
+                             master, path_bank)
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        scenarios = []
+        for index, scenario in pool.imap(record_worker_process, specs,
+                                         chunksize):
+            if scenario is None:
+                raise RuntimeError('Simulation %d failed' % (index,))
+            scenarios.append(scenario)
+    finally:
+        pool.terminate()
+        pool.join()
+    bank = information.ScenarioBank.from_scenarios(
+        scenarios, timesteps, len(trader_specs))
+    bank.save(directory)
+    return bank
+
+def replay_worker_process(spec):
+    """Replay one scenario of a bank (see simulation.ReplaySimulation).
+    Returns the same as worker_process."""
+    (timesteps, marketmaker_fact, trader_specs, live, scenario_bank,
+     index) = spec
+    try:
+        sim_obj = simulation.ReplaySimulation(
+            timesteps, marketmaker_fact,
+            [make_trader(trader_spec) for trader_spec in trader_specs],
+            information.ScenarioBank.load(scenario_bank).path(index), live,
+            log_level='off')
+        sim_obj.simulate()
+    except Exception, e:
+        print >> sys.stderr, type(e), e.args
+        return (index, None, None, None)
+    profits = sim_obj.profits_by_user()
+    market_profit = profits.pop(marketmaker_fact.name)
+    return (index, market_profit,
+            tuple(profits[name] for name in sorted(profits)), None)
+
+def run_replay(trader_list, scenario_bank, live, timesteps=100,
+               num_processes=2, simulations=None, lmsr_b=150,
+               chunksize=50):
+    """Replay the scenarios of the scenario_bank directory (see
+    make_scenario_bank), running only the traders whose indices are in
+    live; the others repeat their recorded orders. trader_list must
+    match the recorded traders in order. Prints and returns the stats
+    like run."""
+    bank = information.ScenarioBank.load(scenario_bank)
+    if simulations is None:
+        simulations = len(bank)
+    check_path_bank(scenario_bank, simulations, timesteps,
+                    len(trader_list))
+    marketmaker_fact = prices.LMSRFactory(lmsr_b)
+    trader_specs = as_trader_specs(trader_list)
+    market_name = marketmaker_fact.name
+    columns = profit_columns(market_name, trader_specs)
+    stats = new_stats(columns)
+    specs = ((timesteps, marketmaker_fact, trader_specs, tuple(live),
+              scenario_bank, index) for index in xrange(simulations))
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        for index, market_profit, trader_profits, _ in pool.imap_unordered(
+                replay_worker_process, specs, chunksize):
+            if market_profit is not None:
+                fold_profits(stats, columns, market_profit, trader_profits)
+    finally:
+        pool.terminate()
+        pool.join()
+    results_by_market = {market_name:stats}
+    report(results_by_market)
+    return results_by_market
+
+def tagged_worker_process(spec):
+    """worker_process, with the worker's pid in front of the result."""
+    return (os.getpid(),) + worker_process(spec)
+
+def check_path_bank(path_bank, simulations, timesteps, traders):
+    bank = information.PathBank.load(path_bank)
+    if (len(bank) < simulations or bank.timesteps != timesteps
+        or bank.traders < traders):
+        raise ValueError('Path bank %s has %d paths of %d timesteps '
+                         'for %d traders' % (path_bank, len(bank),
+                                             bank.timesteps, bank.traders))
+
+def experiment(trader_list, timesteps, num_processes, simulations, lmsr_b,
+               seed, chunksize, path_bank, keep_profits, ordered=False,
+               stop=None, profiler=None, show_progress=None,
+               snapshot_file=None):
+    """Shared body of run and run_until. stop(stats) is asked after
+    every result; when it returns True the pool is terminated, which
+    drops the simulations still queued or running. The workers'
+    profiles are merged into profiler if given. Progress goes to a
+    status line on stderr if show_progress (by default when stderr is
+    a terminal) and to the JSON snapshot_file if given, see
+    progress.Progress. Returns the stats, the profit arrays (or None)
+    and the number of simulations used per market."""
+    if show_progress is None:
+        show_progress = sys.stderr.isatty()
+    master = master_seed(seed)
+    if path_bank is not None:
+        check_path_bank(path_bank, simulations, timesteps, len(trader_list))
     marketmakers = [prices.LMSRFactory(lmsr_b)]
-    
+    trader_specs = as_trader_specs(trader_list)
+
+    results_by_market = {}
+    profits_by_market = {} if keep_profits else None
+    used = {}
+    for marketmaker_fact in marketmakers:
+        market_name = marketmaker_fact.name
+        columns = profit_columns(market_name, trader_specs)
+        stats = new_stats(columns)
+        results_by_market[market_name] = stats
+        if keep_profits:
+            profits = dict((name, numpy.full(simulations, numpy.nan))
+                           for name in columns)
+            profits_by_market[market_name] = profits
+        specs = simulation_specs(simulations, timesteps, marketmaker_fact,
+                                 trader_specs, master, path_bank,
+                                 profile=profiler is not None)
+        pool = multiprocessing.Pool(num_processes)
+        imap = pool.imap if ordered else pool.imap_unordered
+        used[market_name] = 0
+        tracker = None
+        if show_progress or snapshot_file is not None:
+            tracker = progress.Progress(
+                simulations,
+                stream=sys.stderr if show_progress else None,
+                snapshot_file=snapshot_file)
+        try:
+            for (pid, index, market_profit, trader_profits,
+                 totals) in imap(tagged_worker_process, specs, chunksize):
+                used[market_name] += 1
+                if totals is not None:
+                    profiler.merge(totals)
+                if tracker is not None:
+                    tracker.update(market_profit is None, stats, pid)
+                if market_profit is None:
+                    continue
+                fold_profits(stats, columns, market_profit, trader_profits)
+                if keep_profits:
+                    for name, profit in zip(
+                            columns, (market_profit,) + trader_profits):
+                        profits[name][index] = profit
+                if stop is not None and stop(stats):
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+            if tracker is not None:
+                tracker.finish()
+        if keep_profits:
+            for name in columns:
+                profits[name] = profits[name][:used[market_name]]
+    return results_by_market, profits_by_market, used
+
+def run(trader_list, timesteps=100, num_processes=2, simulations=2000,
+        lmsr_b=150, seed=None, chunksize=50, path_bank=None,
+        keep_profits=False, profile=False, show_progress=None,
+        snapshot_file=None):
+    """Run simulations in parallel and print profit statistics. Workers
+    get a spec per simulation and build their own traders (see
+    trader_spec), so trader_list may hold Trader instances or specs.
+    Each simulation has its own random stream derived from seed, so
+    results do not depend on num_processes or chunksize. The
+    information comes from the path_bank directory if given (see
+    make_path_bank), otherwise it is drawn per simulation.
+
+    Results are folded into estimators.RunningStats as they arrive, in
+    any order, so memory does not grow with simulations. Returns
+    {market: {name: RunningStats}} and, with keep_profits, also
+    {market: {name: array of per-simulation profits}} (nan where a
+    simulation failed), otherwise None.
+
+    With profile, every simulation records per trader type call counts
+    and wall time (see profiling.Profiler), and the totals over all
+    workers are printed as a table.
+
+    While running, progress (completed and failed simulations,
+    throughput, ETA and mean profits so far) is shown on stderr when it
+    is a terminal or show_progress is set, and written every second to
+    snapshot_file as JSON if given."""
+    profiler = profiling.Profiler() if profile else None
+    results_by_market, profits_by_market, used = experiment(
+        trader_list, timesteps, num_processes, simulations, lmsr_b, seed,
+        chunksize, path_bank, keep_profits, profiler=profiler,
+        show_progress=show_progress, snapshot_file=snapshot_file)
+    report(results_by_market)
+    if profile:
+        profiler.report()
+    return results_by_market, profits_by_market
+
+def run_until(trader_list, half_width, trader='my_bot', timesteps=100,
+              num_processes=2, max_simulations=20000, min_simulations=100,
+              lmsr_b=150, seed=None, chunksize=10, path_bank=None,
+              keep_profits=False, alpha=0.05, show_progress=None,
+              snapshot_file=None):
+    """Like run, but stop as soon as the 1 - alpha confidence interval
+    of trader's mean profit is narrower than +- half_width, or after
+    max_simulations. Results are taken in simulation order, so for a
+    given seed the simulations used do not depend on num_processes.
+    Progress is shown as in run, with max_simulations as the total.
+    Returns the same as run, plus the number of simulations used."""
+    z = estimators.normal_isf(alpha / 2.0)
+    def stop(stats):
+        count = stats[trader].count
+        return (count >= min_simulations
+                and z * stats[trader].stderr() <= half_width)
+    results_by_market, profits_by_market, used = experiment(
+        trader_list, timesteps, num_processes, max_simulations, lmsr_b,
+        seed, chunksize, path_bank, keep_profits, ordered=True, stop=stop,
+        show_progress=show_progress, snapshot_file=snapshot_file)
+    report(results_by_market)
+    for market_name, stats in results_by_market.iteritems():
+        print ('%s: %d simulations, %s mean profit %1.2f +- %1.2f '
+               '(%d%% confidence, target +- %1.2f)') % (
+            market_name, used[market_name], trader, stats[trader].mean,
+            z * stats[trader].stderr(), round(100 * (1 - alpha)),
+            half_width)
+    return results_by_market, profits_by_market, used
+
+def paired_worker_process(spec):
+    """Run every variant's traders on the same information path and
+    trader ordering. Returns the index and the variants' profit dicts,
+    or None for the profits on failure."""
+    (index, timesteps, marketmaker_fact, variants, seed, antithetic,
+     path_bank) = spec
+    try:
+        if path_bank is None:
+            path = make_path(seed, timesteps,
+                             max(len(specs) for specs in variants),
+                             antithetic)
+        else:
+            path = load_path_bank(path_bank).path(index)
+        profits = []
+        for trader_specs in variants:
+            sim_obj = simulation.Simulation(
+                timesteps, marketmaker_fact,
+                [make_trader(trader_spec) for trader_spec in trader_specs],
+                log_level='off', seed=seed, path=path)
+            sim_obj.simulate()
+            profits.append(sim_obj.profits_by_user())
+    except Exception, e:
+        print >> sys.stderr, type(e), e.args
+        return (index, None)
+    return (index, profits)
+
+def compare(variant_a, variant_b, trader='my_bot', timesteps=100,
+            num_processes=2, simulations=2000, lmsr_b=150, seed=None,
+            chunksize=20, antithetic=False, path_bank=None, alpha=0.05,
+            keep_differences=False):
+    """Paired A/B comparison of two trader lists. Simulation i runs both
+    lists on the same information path, jump schedule and trader
+    ordering (common random numbers), so the noise they share cancels
+    out of the profit difference. trader names the trader whose profit
+    is compared, or is a (name in a, name in b) pair. With antithetic,
+    simulations come in pairs on mirrored paths and each pair counts
+    as one sample, so simulations must be even. Returns RunningStats
+    for the a - b differences and for a and b and, with
+    keep_differences, the array of per-sample differences in
+    simulation order (nan where a simulation failed), otherwise None."""
+    if isinstance(trader, basestring):
+        trader = (trader, trader)
+    if antithetic and path_bank is not None:
+        raise ValueError('Antithetic paths can not come from a path bank')
+    if antithetic and simulations % 2:
+        raise ValueError('Antithetic simulations come in pairs, %d is '
+                         'odd' % (simulations,))
+    if len(variant_a) != len(variant_b):
+        print >> sys.stderr, ('Variants have %d and %d traders, the '
+                              'trader ordering will differ') % (
+            len(variant_a), len(variant_b))
+    if path_bank is not None:
+        check_path_bank(path_bank, simulations, timesteps,
+                        max(len(variant_a), len(variant_b)))
+    master = master_seed(seed)
+    variants = (as_trader_specs(variant_a), as_trader_specs(variant_b))
+    group = 2 if antithetic else 1
+    def specs():
+        for i in xrange(simulations):
+            yield (i, timesteps, prices.LMSRFactory(lmsr_b), variants,
+                   stream_seed(master, i // group), i % group == 1,
+                   path_bank)
+
+    difference = estimators.RunningStats()
+    stats_a = estimators.RunningStats()
+    stats_b = estimators.RunningStats()
+    differences = None
+    if keep_differences:
+        differences = numpy.full(simulations // group, numpy.nan)
+    failed = 0
+    pending = {}
     pool = multiprocessing.Pool(num_processes)
-    sim_objects = []
+    try:
+        for index, profits in pool.imap_unordered(
+                paired_worker_process, specs(), chunksize):
+            if profits is None:
+                failed += 1
+                profits = [{trader[0]:numpy.nan}, {trader[1]:numpy.nan}]
+            pair = pending.setdefault(index // group, [])
+            pair.append((profits[0][trader[0]], profits[1][trader[1]]))
+            if len(pair) < group:
+                continue
+            del pending[index // group]
+            profit_a = sum(a for a, b in pair) / group
+            profit_b = sum(b for a, b in pair) / group
+            if numpy.isnan(profit_a) or numpy.isnan(profit_b):
+                continue
+            if keep_differences:
+                differences[index // group] = profit_a - profit_b
+            difference.update(profit_a - profit_b)
+            stats_a.update(profit_a)
+            stats_b.update(profit_b)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    z = estimators.normal_isf(alpha / 2.0)
+    print ('%s (a) - %s (b) paired profit difference: %1.2f +- %1.2f '
+           '(%d%% confidence, %1.2f std, %d samples, %d failed)') % (
+        trader[0], trader[1], difference.mean, z * difference.stderr(),
+        round(100 * (1 - alpha)), difference.std(), difference.count,
+        failed)
+    for name, label, stats in zip(trader, 'ab', (stats_a, stats_b)):
+        print '    %s (%s) profit: %1.2f (%1.2f std)' % (
+            name, label, stats.mean, stats.std())
+    independent = stats_a.variance(ddof=1) + stats_b.variance(ddof=1)
+    if independent > 0:
+        ratio = '%1.3f' % (difference.variance(ddof=1) / independent,)
+    else:
+        # neither profit varies, e.g. bots that never trade
+        ratio = 'n/a'
+    print ('    variance of the difference is %s of that of '
+           'independent runs') % (ratio,)
+    return difference, stats_a, stats_b, differences
+
+def ensemble_worker_process(args):
+    simulations, timesteps, marketmaker_fact, trader_list, seed = args
+    try:
+        sim_obj = ensemble.EnsembleSimulation(
+            simulations, timesteps, marketmaker_fact,
+            ensemble.vectorize(trader_list), seed=numpy_seed(seed))
+        sim_obj.simulate()
+    except Exception, e:
+        print >> sys.stderr, type(e), e.args
+        return (None, None)
+    return (marketmaker_fact.name, sim_obj.profits_by_user())
+
+def run_ensemble(trader_list, timesteps=100, num_processes=2,
+                 simulations=2000, lmsr_b=150, batch_size=1000, seed=None):
+    """Like run, but each worker steps a whole batch of simulations
+    together with ensemble.EnsembleSimulation. Only traders with an
+    ensemble counterpart are supported. Each batch has its own random
+    stream, so results depend on seed and batch_size only. Prints the
+    stats and how many batches failed, and returns
+    {market: {name: RunningStats}}."""
+    ensemble.vectorize(trader_list)
+    master = master_seed(seed)
+    marketmakers = [ensemble.EnsembleLMSRFactory(lmsr_b)]
+
+    batches = []
     for marketmaker_fact in marketmakers:
-        for i in range(simulations):
-            sim_objects.append(simulation.Simulation(
-                    timesteps, marketmaker_fact,
-                    trader_list))
-    results = pool.map(worker_process, sim_objects)
+        for index, start in enumerate(range(0, simulations, batch_size)):
+            batches.append((min(batch_size, simulations - start),
+                            timesteps, marketmaker_fact, trader_list,
+                            stream_seed(master, index)))
     results_by_market = {}
-    max_profit_by_market = {}
-    min_profit_by_market = {}
-    for market_name, profits_by_user  in results:
-        if market_name is None:
+    failed = 0
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        for market_name, profits_by_user in pool.imap_unordered(
+                ensemble_worker_process, batches):
+            if market_name is None:
+                failed += 1
+                continue
+            stats = results_by_market.setdefault(market_name, {})
+            for user_type, profits in profits_by_user.iteritems():
+                stats.setdefault(
+                    user_type, estimators.RunningStats()).update_many(profits)
+    finally:
+        pool.terminate()
+        pool.join()
+    if failed:
+        print >> sys.stderr, '%d of %d batches failed' % (failed,
+                                                          len(batches))
+    report(results_by_market)
+    return results_by_market
+
+# Set in each worker of run_shared by attach_results: the job and the
+# results matrix in shared memory.
+_shared_job = None
+_shared_results = None
+
+def attach_results(job, buffer, shape):
+    global _shared_job, _shared_results
+    _shared_job = job
+    _shared_results = numpy.frombuffer(buffer).reshape(shape)
+
+def shared_worker_process(chunk):
+    """Run simulations start to stop of the attached job, writing each
+    one's profits, final mu and final p into its row of the shared
+    results. Failed simulations keep their row of nan. Returns the
+    number that failed."""
+    start, stop = chunk
+    timesteps, marketmaker_fact, trader_specs, master, path_bank = (
+        _shared_job)
+    failed = 0
+    for spec in simulation_specs(stop, timesteps, marketmaker_fact,
+                                 trader_specs, master, path_bank,
+                                 start=start):
+        index, sim_obj = simulate_spec(spec)
+        if sim_obj is None:
+            failed += 1
             continue
-        for user_type, profit_list in profits_by_user.iteritems():
-            results_by_market.setdefault(market_name, {}).setdefault(
-                user_type, []).append(profit_list)
-            if user_type == market_name:
-                if profit_list > max_profit_by_market.get(
-                    market_name, float('-inf')):
-                    max_profit_by_market[market_name] = profit_list
-                if profit_list < min_profit_by_market.get(
-                    market_name, float('inf')):
-                    min_profit_by_market[market_name] = profit_list
-    for market_name, profit_dict in results_by_market.iteritems():
+        profits = sim_obj.profits_by_user()
+        row = _shared_results[index]
+        row[0] = profits.pop(marketmaker_fact.name)
+        row[1:-2] = [profits[name] for name in sorted(profits)]
+        row[-2] = sim_obj.final_mu
+        row[-1] = sim_obj.p_vec[-1]
+    return failed
+
+def run_shared(trader_list, timesteps=100, num_processes=2,
+               simulations=2000, lmsr_b=150, seed=None, chunksize=500,
+               path_bank=None):
+    """Like run, for many short simulations. The workers write every
+    simulation's results straight into a matrix in shared memory
+    instead of returning them, and get chunksize simulations per task,
+    so nothing is pickled per simulation. Prints the stats and returns
+    them with the column names and the simulations x columns matrix:
+    the market maker's profit, the traders' profits ordered like
+    trader_names(), the final mu and the final p, nan where a
+    simulation failed."""
+    master = master_seed(seed)
+    if path_bank is not None:
+        check_path_bank(path_bank, simulations, timesteps, len(trader_list))
+    marketmaker_fact = prices.LMSRFactory(lmsr_b)
+    trader_specs = as_trader_specs(trader_list)
+    market_name = marketmaker_fact.name
+    columns = profit_columns(market_name, trader_specs) + ['final_mu',
+                                                           'final_p']
+    shape = (simulations, len(columns))
+    buffer = multiprocessing.RawArray(ctypes.c_double,
+                                      simulations * len(columns))
+    results = numpy.frombuffer(buffer).reshape(shape)
+    results[:] = numpy.nan
+    job = (timesteps, marketmaker_fact, trader_specs, master, path_bank)
+    chunks = [(start, min(start + chunksize, simulations))
+              for start in xrange(0, simulations, chunksize)]
+    pool = multiprocessing.Pool(num_processes, attach_results,
+                                (job, buffer, shape))
+    try:
+        failed = sum(pool.imap_unordered(shared_worker_process, chunks))
+    finally:
+        pool.terminate()
+        pool.join()
+    if failed:
+        print >> sys.stderr, '%d simulations failed' % (failed,)
+    ok = results[~numpy.isnan(results[:, 0])]
+    stats = {}
+    for column, name in enumerate(columns[:-2]):
+        stats[name] = estimators.RunningStats()
+        stats[name].update_many(ok[:, column])
+    results_by_market = {market_name:stats}
+    report(results_by_market)
+    return results_by_market, columns, results
+
+def report(results_by_market):
+    """Print {market: {name: RunningStats}}."""
+    for market_name, stats_dict in results_by_market.iteritems():
+        market_stats = stats_dict[market_name]
         print ('%s profit: %1.2f (min %1.2f, '
                'max %1.2f, %d samples)') % (
-            market_name, numpy.mean(profit_dict[market_name]),
-            min_profit_by_market[market_name],
-            max_profit_by_market[market_name],
-            len(profit_dict[market_name]))
-        for user_type, profit_list in profit_dict.iteritems():
+            market_name, market_stats.mean, market_stats.min,
+            market_stats.max, market_stats.count)
+        for user_type, stats in stats_dict.iteritems():
             if user_type == market_name:
                 continue
             print ('    %s profit: %1.2f (%1.2f min, %1.2f max, '
                    '%1.2f std, %d samples)') % (
-                user_type, numpy.mean(profit_list),
-                min(profit_list), max(profit_list),
-                numpy.std(profit_list), len(profit_list))
+                user_type, stats.mean, stats.min, stats.max, stats.std(),
+                stats.count)
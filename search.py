@@ -0,0 +1,175 @@
+import estimators
+import math
+import multiprocessing
+import my_bot
+import other_bots
+import prices
+import random
+import run_experiments
+import sweep
+
+# Tuning knobs of a trader. Each value is a list to choose from or a
+# function of a random.Random that draws a value. A search space maps
+# trader names to knobs; tune only the trader being scored, or it can
+# win by making the others trade badly.
+MY_BOT_KNOBS = {'jump_detection':['cusum', 'window'],
+                'window_length':[10, 15, 20, 30, 40],
+                'sigma':[10, 15, 20, 25, 30],
+                'cusum_threshold':lambda rng: rng.uniform(3.0, 12.0),
+                'belief_blend':lambda rng: rng.uniform(0.25, 1.0),
+                'riskiness':[0.5, 1, 2, 4]}
+MOVING_AVERAGE_KNOBS = {'alpha':lambda rng: rng.uniform(0.5, 0.99),
+                        'min_block_size':[1, 2, 4],
+                        'start_block_size':[5, 10, 20, 40]}
+
+def sample(space, rng):
+    """One config, {trader name: params}, drawn from space."""
+    config = {}
+    for name, knobs in space.iteritems():
+        config[name] = {}
+        for knob, values in sorted(knobs.iteritems()):
+            if callable(values):
+                config[name][knob] = values(rng)
+            else:
+                config[name][knob] = rng.choice(values)
+    return config
+
+def default_traders(config, num_fundamentals=8, num_technical=2):
+    """MyBot and other_bots.get_bots, with the params config has for
+    their names."""
+    bots = [my_bot.MyBot()] + other_bots.get_bots(num_fundamentals,
+                                                  num_technical)
+    return [type(bot)(**config.get(bot.name, {})) for bot in bots]
+
+class Candidate(object):
+    """A config and the profits of its first `simulations` runs, of
+    which `failed` failed. A candidate with failures is invalid and
+    scores -inf."""
+    def __init__(self, config, trader_specs):
+        self.config = config
+        self.trader_specs = trader_specs
+        self.simulations = 0
+        self.failed = 0
+        self.stats = None
+
+    def valid(self):
+        return self.failed == 0
+
+    def score(self, trader):
+        if not self.valid():
+            return float('-inf')
+        return self.stats[trader].mean
+
+def evaluate(pool, candidates, simulations, timesteps, lmsr_b, master,
+             chunksize):
+    """Extend every candidate to its first `simulations` runs. All
+    candidates use the same seeds, so they are compared on the same
+    information paths. Failed simulations are counted in each
+    candidate's failed."""
+    def specs():
+        for index, candidate in enumerate(candidates):
+            for spec in run_experiments.simulation_specs(
+                    simulations, timesteps, prices.LMSRFactory(lmsr_b),
+                    candidate.trader_specs, master,
+                    start=candidate.simulations):
+                yield index, spec
+    columns = []
+    for candidate in candidates:
+        columns.append(run_experiments.profit_columns(
+                'market_maker', candidate.trader_specs))
+        if candidate.stats is None:
+            candidate.stats = run_experiments.new_stats(columns[-1])
+    for index, sim_index, market_profit, trader_profits, totals in (
+            pool.imap_unordered(sweep.sweep_worker_process, specs(),
+                                chunksize)):
+        if market_profit is None:
+            candidates[index].failed += 1
+            continue
+        run_experiments.fold_profits(candidates[index].stats, columns[index],
+                                     market_profit, trader_profits)
+    for candidate in candidates:
+        candidate.simulations = simulations
+
+def successive_halving(configs, trader='my_bot', min_simulations=50,
+                       max_simulations=2000, eta=3, timesteps=100,
+                       lmsr_b=150, seed=0, make_traders=default_traders,
+                       num_processes=2, chunksize=10, pool=None):
+    """Run every config for min_simulations, keep the best 1/eta by
+    trader's mean profit, run those eta times as long, and so on until
+    one config is left or max_simulations is reached. Configs whose
+    traders reject their params raise at once; configs with failed
+    simulations rank last, and if all have failures RuntimeError is
+    raised. Returns the surviving Candidates, best first."""
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(num_processes)
+    try:
+        candidates = [
+            Candidate(config, tuple(run_experiments.trader_spec(bot)
+                                    for bot in make_traders(config)))
+            for config in configs]
+        for candidate in candidates:
+            run_experiments.check_trader_specs(candidate.trader_specs,
+                                               timesteps)
+        simulations = min_simulations
+        while True:
+            evaluate(pool, candidates, simulations, timesteps, lmsr_b,
+                     seed, chunksize)
+            candidates.sort(key=lambda candidate: candidate.score(trader),
+                            reverse=True)
+            if not candidates[0].valid():
+                raise RuntimeError('Simulations failed for all %d configs'
+                                   % (len(candidates),))
+            print '%d configs x %d simulations, best %s profit %1.2f' % (
+                len(candidates), simulations, trader,
+                candidates[0].score(trader))
+            if len(candidates) == 1 or simulations >= max_simulations:
+                return candidates
+            candidates = candidates[:max(1, len(candidates) // eta)]
+            simulations = min(simulations * eta, max_simulations)
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+def hyperband(space=None, trader='my_bot', max_simulations=2000, eta=3,
+              timesteps=100, lmsr_b=150, seed=0,
+              make_traders=default_traders, num_processes=2, chunksize=10):
+    """Hyperband over configs sampled from space, MyBot's knobs by
+    default. It runs successive halving brackets that trade many
+    configs on few simulations against few configs on many, on one
+    shared pool. Returns the best Candidate and prints its config."""
+    if space is None:
+        space = {'my_bot':MY_BOT_KNOBS}
+    rng = random.Random(seed)
+    s_max = int(math.log(max_simulations) / math.log(eta) + 1e-9)
+    pool = multiprocessing.Pool(num_processes)
+    best = None
+    try:
+        for s in range(s_max, -1, -1):
+            configs = int(math.ceil((s_max + 1) * eta ** s / (s + 1.0)))
+            min_simulations = max(1, int(max_simulations * eta ** -s))
+            print 'bracket %d: %d configs from %d simulations' % (
+                s, configs, min_simulations)
+            survivors = successive_halving(
+                [sample(space, rng) for i in range(configs)], trader,
+                min_simulations, max_simulations, eta, timesteps, lmsr_b,
+                seed, make_traders, chunksize=chunksize, pool=pool)
+            top = survivors[0]
+            if top.simulations < max_simulations:
+                evaluate(pool, [top], max_simulations, timesteps, lmsr_b,
+                         seed, chunksize)
+            if best is None or top.score(trader) > best.score(trader):
+                best = top
+    finally:
+        pool.terminate()
+        pool.join()
+    if not best.valid():
+        raise RuntimeError('Simulations failed for every bracket\'s best '
+                           'config')
+    print ('best %s profit %1.2f +- %1.2f (95%% confidence) over %d '
+           'simulations: %s') % (
+        trader, best.score(trader),
+        estimators.normal_isf(0.025) * best.stats[trader].stderr(),
+        best.simulations, best.config)
+    return best
@@ -1,27 +1,130 @@
+import numpy
 import random
 import prices
 import traders
 import information
+import profiling
 
-class Flag(object):
+class Flag(prices.Slotted):
+    __slots__ = ('value',)
     def __init__(self, default=False):
         self.value = default
 
 class Log(object):
-    def __init__(self):
-        self.events = []
+    """Columnar event log. Each event type gets its own structured numpy
+    array, grown by doubling, so filter() can return a view of it. Users
+    are interned to integer ids, see users and user_id.
+
+    level picks what is recorded: 'all', 'execute' (executions only) or
+    'off'. beliefs and execution_prices are always kept, the traders
+    read execution_prices."""
+    LEVELS = {'off':0, 'execute':1, 'all':2}
+    EVENT_LEVELS = {'check':2, 'check_many':2, 'quantity':2, 'execute':1}
+    SIDES = {'buy':0, 'sell':1}
+    DTYPE = numpy.dtype([('time', numpy.int32), ('user', numpy.int32),
+                         ('side', numpy.int8), ('quantity', numpy.float64),
+                         ('price', numpy.float64), ('mu', numpy.float64)])
+
+    def __init__(self, level='all', flush_size=4096):
+        self.level = self.LEVELS[level]
+        self.flush_size = flush_size
+        self.tables = {}
+        self.sizes = {}
+        self.pending = {}
+        self.users = []
+        self.user_ids = {}
         self.beliefs = []
         self.execution_prices = []
 
+    def user_id(self, name):
+        if name not in self.user_ids:
+            self.user_ids[name] = len(self.users)
+            self.users.append(name)
+        return self.user_ids[name]
+
+    def _reserve(self, event_type, rows):
+        size = self.sizes.get(event_type, 0)
+        table = self.tables.get(event_type)
+        if table is None or size + rows > len(table):
+            capacity = max(64, 2 * (size + rows))
+            grown = numpy.zeros(capacity, dtype=self.DTYPE)
+            if table is not None:
+                grown[:size] = table[:size]
+            self.tables[event_type] = table = grown
+        self.sizes[event_type] = size + rows
+        return table[size:size + rows]
+
+    def _flush(self, event_type):
+        # single events are buffered as tuples, writing a structured
+        # array one row at a time is much slower than appending to a list
+        pending = self.pending.get(event_type)
+        if pending:
+            self._reserve(event_type, len(pending))[:] = pending
+            del pending[:]
+
+    def flush(self):
+        for event_type in self.pending:
+            self._flush(event_type)
+
     def event(self, time, event_type, user, buysell, quantity, mu,
               other=None):
-        self.events.append((time, event_type, user.name, buysell, quantity,
-                            other))
+        """Record an event. quantity and other may be arrays (one row
+        per element), other is the price and None is stored as nan."""
         if event_type == 'execute' and other is not None:
             self.execution_prices.append((other, buysell, quantity, mu))
+        if self.EVENT_LEVELS[event_type] > self.level:
+            return
+        if other is None:
+            other = numpy.nan
+        user_id = self.user_ids.get(user.name)
+        if user_id is None:
+            user_id = self.user_id(user.name)
+        if not isinstance(quantity, numpy.ndarray):
+            pending = self.pending.get(event_type)
+            if pending is None:
+                pending = self.pending[event_type] = []
+            pending.append((time, user_id, self.SIDES[buysell], quantity,
+                            other, mu))
+            if len(pending) >= self.flush_size:
+                self._flush(event_type)
+            return
+        self._flush(event_type)
+        rows = self._reserve(event_type, len(quantity))
+        rows['time'] = time
+        rows['user'] = user_id
+        rows['side'] = self.SIDES[buysell]
+        rows['quantity'] = quantity
+        rows['price'] = other
+        rows['mu'] = mu
+
+    def __getstate__(self):
+        self.flush()
+        state = dict(self.__dict__)
+        state['tables'] = dict(
+            (event_type, table[:self.sizes[event_type]])
+            for event_type, table in self.tables.iteritems())
+        return state
 
-    def filter(self, event_type):
-        return [e for e in self.events if e[1] == event_type]
+    def filter(self, event_type, user=None):
+        """Events of one type as a structured array with fields time,
+        user, side, quantity, price and mu. Without user this is a view
+        of the log; with a user name it is a (copied) selection."""
+        self._flush(event_type)
+        table = self.tables.get(event_type)
+        if table is None:
+            return numpy.zeros(0, dtype=self.DTYPE)
+        events = table[:self.sizes[event_type]]
+        if user is not None:
+            if user not in self.user_ids:
+                return events[:0]
+            events = events[events['user'] == self.user_ids[user]]
+        return events
+
+class Clock(prices.Slotted):
+    """The current timestep, shared by all callbacks of a simulation."""
+    __slots__ = ('time',)
+    def __init__(self, time=None):
+        self.time = time
 
 def make_cash_callback(user):
     def cash_callback():
@@ -33,34 +136,100 @@ def make_shares_callback(user, market):
         return user.shares.get(market.id, 0)
     return shares_callback
 
-def make_check_callback(market_maker, user, flag, log, time):
+def make_check_callback(market_maker, user, flag, log, clock):
     def check_callback(buysell, quantity):
         assert buysell in ['buy', 'sell']
         assert quantity > 0
         flag.value = True
         per_share = prices.check(buysell, quantity, market_maker, user)
-        log.event(time, 'check', user, buysell, quantity, market_maker.mu,
-                  other=per_share)
+        log.event(clock.time, 'check', user, buysell, quantity,
+                  market_maker.mu, other=per_share)
         return per_share
     return check_callback
 
-def make_execute_callback(market_maker, user, flag, log, time):
+def make_check_many_callback(market_maker, user, flag, log, clock):
+    def check_many_callback(buysell, quantities):
+        assert buysell in ['buy', 'sell']
+        quantities = numpy.asarray(quantities)
+        assert (quantities > 0).all()
+        flag.value = True
+        per_share = prices.check_many(buysell, quantities, market_maker,
+                                      user)
+        log.event(clock.time, 'check_many', user, buysell, quantities,
+                  market_maker.mu, other=per_share)
+        return per_share
+    return check_many_callback
+
+def make_quantity_callback(market_maker, user, flag, log, clock):
+    def quantity_callback(buysell, price, marginal=False):
+        assert buysell in ['buy', 'sell']
+        flag.value = True
+        quantity = prices.max_quantity(buysell, price, market_maker, user,
+                                       marginal)
+        log.event(clock.time, 'quantity', user, buysell, quantity,
+                  market_maker.mu, other=price)
+        return quantity
+    return quantity_callback
+
+def make_execute_callback(market_maker, user, flag, log, clock):
     def execute_callback(buysell, quantity):
         assert buysell in ['buy', 'sell']
         assert quantity > 0
         flag.value = True
         previous_mu = market_maker.mu
         success = prices.execute(buysell, quantity, market_maker, user)
-        log.event(time, 'execute', user, buysell, quantity,
+        log.event(clock.time, 'execute', user, buysell, quantity,
                   previous_mu, other=success)
         return success
     return execute_callback
 
+class TraderContext(object):
+    """The callbacks one trader gets at its trading opportunities, made
+    once per simulation. They read the time from the shared clock, so
+    nothing is allocated per trading opportunity. keywords holds the
+    optional callbacks trader accepts (see traders.optional_callbacks),
+    to pass as trading_opportunity(..., **keywords); all of them if no
+    trader is given."""
+    __slots__ = ('check_flag', 'execute_flag', 'cash_callback',
+                 'shares_callback', 'check_callback', 'execute_callback',
+                 'quantity_callback', 'check_many_callback', 'keywords')
+
+    def __init__(self, market_maker, user, log, clock, profiler=None,
+                 name=None, trader=None):
+        self.check_flag = Flag()
+        self.execute_flag = Flag()
+        self.cash_callback = make_cash_callback(user)
+        self.shares_callback = make_shares_callback(user, market_maker)
+        self.check_callback = make_check_callback(
+            market_maker, user, self.check_flag, log, clock)
+        self.execute_callback = make_execute_callback(
+            market_maker, user, self.execute_flag, log, clock)
+        self.quantity_callback = make_quantity_callback(
+            market_maker, user, self.check_flag, log, clock)
+        self.check_many_callback = make_check_many_callback(
+            market_maker, user, self.check_flag, log, clock)
+        if profiler is not None:
+            for event in ['check', 'execute', 'quantity', 'check_many']:
+                attribute = event + '_callback'
+                setattr(self, attribute, profiler.timed(
+                        name, event, getattr(self, attribute)))
+        if trader is None:
+            accepted = traders.OPTIONAL_CALLBACKS
+        else:
+            accepted = traders.optional_callbacks(trader)
+        self.keywords = dict((callback, getattr(self, callback))
+                             for callback in accepted)
+
+    def opportunity(self):
+        self.check_flag.value = False
+        self.execute_flag.value = False
+
 class Simulation(object):
     def __init__(self, timesteps, market_fact, trader_list,
                  initial_cash=0, initial_shares=0,
                  jump_probability=None, initial_p=None,
-                 spread_calculations=None):
+                 spread_calculations=None, log_level='all', seed=None,
+                 path=None, profile=False, record=False):
         self.traders = trader_list
         self.possible_jump_locations = [a for a in range(timesteps)]
         if jump_probability is None:
@@ -76,10 +245,30 @@ class Simulation(object):
         self.user_list = None
         self.liqudiation = None
         self.market_maker_user = None
-        self.log = Log()
+        self.log = Log(log_level)
         self.initial_p = initial_p
+        # with a seed the simulation draws everything from its own
+        # random.Random, otherwise from the global random module
+        self.seed = seed
+        # an information.InformationPath to replay instead of drawing
+        # the information as the simulation goes
+        self.path = path
+        # with profile, per trader call counts and times end up in
+        # profiler.totals
+        self.profiler = profiling.Profiler() if profile else None
+        # with record, the information, trading order and executed
+        # orders end up in recording, an information.Scenario
+        self.record = record
+        self.recording = None
+        self.quote_hits = None
+        self.quote_misses = None
+        self.final_mu = None
         
     def simulate(self):
+        if self.seed is None:
+            rng = random
+        else:
+            rng = random.Random(self.seed)
         market = self.market_fact.make()
         def user_callback(trader, i):
             return prices.User(self.initial_cash,
@@ -88,36 +277,100 @@ class Simulation(object):
         trading_bots = traders.TradingPopulation(
             self.timesteps, self.possible_jump_locations,
             self.jump_probability, self.traders,
-            user_callback=user_callback)
-        binom = information.BinomialDraws(self.initial_p)
+            user_callback=user_callback, rng=rng, profiler=self.profiler)
+        profiler = self.profiler
+        clock = Clock()
+        contexts = dict(
+            (trader_user, TraderContext(market, trader_user, self.log,
+                                        clock, profiler, trader.name,
+                                        trader))
+            for trader, trader_user in trading_bots.active_traders)
+        if self.path is None:
+            source = information.BinomialDraws(self.initial_p, rng=rng)
+            steps = source.steps(self.timesteps, self.jump_probability)
+        else:
+            assert self.path.draws.shape[1] >= len(self.traders)
+            steps = self.path.steps()
+        record = self.record
+        if record:
+            indices = dict(
+                (trader_user, i) for i, (trader, trader_user)
+                in enumerate(trading_bots.active_traders))
+            draws, schedule, orders = [], [], []
+        execution_prices = self.log.execution_prices
         p_vec = []
-        for i in range(self.timesteps):
-            if random.random() < self.jump_probability:
-                binom.do_jump()
-            p_vec.append(binom._p)
+        for i, (p, get_draw) in enumerate(steps):
+            p_vec.append(p)
             self.log.beliefs.append((i, market.mu))
-            if binom._p == 1.0 or binom._p == 0.0:
+            if p == 1.0 or p == 0.0:
                 break
+            if record:
+                step_draws = []
+                draws.append(step_draws)
+                def get_draw(get_draw=get_draw, step_draws=step_draws):
+                    draw = get_draw()
+                    step_draws.append(draw)
+                    return draw
             trading_bots.new_information(
-                binom.get_draw,
-                self.log.execution_prices, i)
+                get_draw,
+                execution_prices, i)
             active_traders = trading_bots.get_traders()
+            if record:
+                schedule.append([indices[trader_user]
+                                 for trader, trader_user in active_traders])
+            clock.time = i
             for trader, trader_user in active_traders:
-                check_flag = Flag()
-                execute_flag = Flag()
+                context = contexts[trader_user]
+                context.opportunity()
+                if record:
+                    executed = len(execution_prices)
+                if profiler is not None:
+                    start = profiling.clock()
                 trader.trading_opportunity(
-                    make_cash_callback(trader_user),
-                    make_shares_callback(trader_user, market),
-                    make_check_callback(market, trader_user,
-                                        check_flag, self.log, i),
-                    make_execute_callback(market, trader_user,
-                                          execute_flag, self.log, i),
-                    market.mu)
+                    context.cash_callback, context.shares_callback,
+                    context.check_callback, context.execute_callback,
+                    market.mu, **context.keywords)
+                if profiler is not None:
+                    profiler.add(trader.name, 'trading_opportunity',
+                                 profiling.clock() - start)
+                if record:
+                    for price, buysell, quantity, mu in (
+                            execution_prices[executed:]):
+                        orders.append((i, indices[trader_user],
+                                       information.SIDES.index(buysell),
+                                       quantity))
+        if record:
+            jumps = source.jumps if self.path is None else self.path.jumps
+            self.recording = self._recording(
+                trading_bots, indices, p_vec, jumps, draws, schedule,
+                orders)
         self.p_vec = p_vec
         self.user_list = trading_bots.all_users(
             lambda trader:(trader[0].name, trader[1]))
         self.liquidation = {market.id:100.0 * p_vec[-1]}
         self.market_maker_user = market.user_account
+        self.quote_hits = market.quote_hits
+        self.quote_misses = market.quote_misses
+        self.final_mu = market.mu
+
+    def _recording(self, trading_bots, indices, p_vec, jumps, draws,
+                   schedule, orders):
+        traders = len(self.traders)
+        draw_columns = numpy.zeros(traders, dtype=numpy.int16)
+        for column, (trader, trader_user) in enumerate(
+                trading_bots.information_order()):
+            draw_columns[indices[trader_user]] = column
+        # the last timestep has no draws or trading if it stopped early
+        draw_matrix = numpy.zeros((len(p_vec), traders), dtype=numpy.uint8)
+        draw_matrix[:len(draws)] = draws
+        schedule_matrix = numpy.empty((len(p_vec), traders),
+                                      dtype=numpy.int16)
+        schedule_matrix.fill(-1)
+        schedule_matrix[:len(schedule)] = schedule
+        return information.Scenario(
+            numpy.array(p_vec), numpy.array(jumps[:len(p_vec)], dtype=bool),
+            draw_matrix, schedule_matrix, draw_columns,
+            numpy.array(orders, dtype=information.ORDER_DTYPE))
 
     def profits_by_user(self):
         assert self.user_list is not None
@@ -129,3 +382,210 @@ class Simulation(object):
         for trader_name, profit_list in ret.iteritems():
             ret[trader_name] = sum(profit_list)
         return ret
+
+class ReplaySimulation(Simulation):
+    """Replays an information.Scenario recorded by a Simulation with the
+    same traders. Only the traders whose indices are in live run their
+    strategies; they get the draws and trading order of the recording.
+    The others are not run at all, their recorded orders are executed
+    again at their turn, at whatever the prices are now. With every
+    trader live, or none, the replay reproduces the recording."""
+    def __init__(self, timesteps, market_fact, trader_list, scenario, live,
+                 initial_cash=0, initial_shares=0, log_level='all'):
+        Simulation.__init__(self, timesteps, market_fact, trader_list,
+                            initial_cash=initial_cash,
+                            initial_shares=initial_shares,
+                            log_level=log_level, path=scenario)
+        self.live = sorted(live)
+
+    def simulate(self):
+        scenario = self.path
+        market = self.market_fact.make()
+        users = [prices.User(self.initial_cash,
+                             {market.id:self.initial_shares},
+                             name='%d (%s)' % (i, trader.name))
+                 for i, trader in enumerate(self.traders)]
+        live = self.live
+        trading_bots = traders.TradingPopulation(
+            self.timesteps, self.possible_jump_locations,
+            self.jump_probability, [self.traders[i] for i in live],
+            user_callback=lambda trader, j: users[live[j]])
+        indices = dict((user, i) for i, user in enumerate(users))
+        columns = [scenario.draw_columns[indices[trader_user]]
+                   for trader, trader_user
+                   in trading_bots.information_order()]
+        clock = Clock()
+        live_traders = {}
+        for trader, trader_user in trading_bots.active_traders:
+            live_traders[indices[trader_user]] = (trader, TraderContext(
+                    market, trader_user, self.log, clock, trader=trader))
+        # execute callbacks for the replayed traders
+        replayed = dict((i, make_execute_callback(market, user, Flag(),
+                                                  self.log, clock))
+                        for i, user in enumerate(users)
+                        if i not in live_traders)
+        orders = scenario.orders
+        order_times = orders['time'].tolist()
+        order_traders = orders['trader'].tolist()
+        order_sides = [information.SIDES[side]
+                       for side in orders['side'].tolist()]
+        order_quantities = orders['quantity'].tolist()
+        next_order = 0
+        p_vec = []
+        for i in xrange(len(scenario)):
+            p = float(scenario.p_vec[i])
+            p_vec.append(p)
+            self.log.beliefs.append((i, market.mu))
+            if p == 1.0 or p == 0.0:
+                break
+            if live:
+                trading_bots.new_information(
+                    iter(scenario.draws[i, columns].tolist()).next,
+                    self.log.execution_prices, i)
+            clock.time = i
+            for index in scenario.schedule[i].tolist():
+                if index < 0:
+                    break
+                if index in live_traders:
+                    trader, context = live_traders[index]
+                    context.opportunity()
+                    trader.trading_opportunity(
+                        context.cash_callback, context.shares_callback,
+                        context.check_callback, context.execute_callback,
+                        market.mu, **context.keywords)
+                    execute = None
+                else:
+                    execute = replayed[index]
+                # the orders this trader made at this turn
+                while (next_order < len(order_times)
+                       and order_times[next_order] == i
+                       and order_traders[next_order] == index):
+                    if execute is not None:
+                        execute(order_sides[next_order],
+                                order_quantities[next_order])
+                    next_order += 1
+        self.p_vec = p_vec
+        self.user_list = [(owner.name, account)
+                          for owner, account in zip(self.traders, users)]
+        self.liquidation = {market.id:100.0 * p_vec[-1]}
+        self.market_maker_user = market.user_account
+        self.quote_hits = market.quote_hits
+        self.quote_misses = market.quote_misses
+        self.final_mu = market.mu
+
+class MultiMarketSimulation(object):
+    """A Simulation over an LMSRBook of many n-outcome markets. Trader i
+    trades the contract routes[i] = (market, outcome), by default the
+    contracts in turn. Each contract with traders gets its own Log and
+    TradingPopulation, so its traders see its executions and draws on
+    its outcome's probability; all traders share one shuffled order per
+    timestep. Unlike Simulation there is no early stop, the markets are
+    liquidated at the final probabilities."""
+    def __init__(self, timesteps, book_fact, trader_list, routes=None,
+                 initial_cash=0, initial_shares=0, jump_probability=None,
+                 log_level='all', seed=None):
+        self.traders = trader_list
+        self.timesteps = timesteps
+        self.possible_jump_locations = range(timesteps)
+        if jump_probability is None:
+            self.jump_probability = 1.0 / float(timesteps)
+        else:
+            self.jump_probability = jump_probability
+        self.book_fact = book_fact
+        self.routes = routes
+        self.initial_cash = initial_cash
+        self.initial_shares = initial_shares
+        self.log_level = log_level
+        self.seed = seed
+        self.logs = None
+        self.p_vec = None
+        self.user_list = None
+        self.liquidation = None
+        self.market_profits = None
+        self.market_maker_user = None
+
+    def simulate(self):
+        if self.seed is None:
+            rng = random
+        else:
+            rng = random.Random(self.seed)
+        numpy_rng = numpy.random.RandomState(rng.randint(0, 2 ** 32 - 1))
+        book = self.book_fact.make()
+        routes = self.routes
+        if routes is None:
+            contracts = book.markets * book.outcomes
+            routes = [divmod(i % contracts, book.outcomes)
+                      for i in range(len(self.traders))]
+        assert len(routes) == len(self.traders)
+        by_route = {}
+        for i, route in enumerate(routes):
+            by_route.setdefault(tuple(route), []).append(i)
+        clock = Clock()
+        self.logs = {}
+        groups = []
+        opportunities = []
+        flat_contracts = []
+        for route in sorted(by_route):
+            contract = book.contract(*route)
+            log = Log(self.log_level)
+            indices = by_route[route]
+            def user_callback(trader, j, indices=indices, contract=contract):
+                return prices.User(self.initial_cash,
+                                   {contract.id:self.initial_shares},
+                                   name='%d (%s)' % (indices[j],
+                                                     trader.name))
+            population = traders.TradingPopulation(
+                self.timesteps, self.possible_jump_locations,
+                self.jump_probability,
+                [self.traders[i] for i in indices],
+                user_callback=user_callback, rng=rng)
+            for trader, trader_user in population.active_traders:
+                opportunities.append((trader, contract, TraderContext(
+                            contract, trader_user, log, clock,
+                            trader=trader)))
+            start = len(flat_contracts)
+            flat_contracts.extend([route[0] * book.outcomes + route[1]]
+                                  * len(indices))
+            groups.append((contract, log, population, start,
+                           len(flat_contracts)))
+            self.logs[route] = log
+        flat_contracts = numpy.array(flat_contracts, dtype=numpy.intp)
+        draws = information.OutcomeDraws(book.markets, book.outcomes,
+                                         rng=numpy_rng)
+        p_vec = []
+        for i, p in enumerate(draws.steps(self.timesteps,
+                                          self.jump_probability)):
+            p_vec.append(p.copy())
+            draw_list = draws.draws(p, flat_contracts).tolist()
+            for contract, log, population, start, end in groups:
+                log.beliefs.append((i, contract.mu))
+                population.new_information(
+                    iter(draw_list[start:end]).next, log.execution_prices,
+                    i)
+            rng.shuffle(opportunities)
+            clock.time = i
+            for trader, contract, context in opportunities:
+                context.opportunity()
+                trader.trading_opportunity(
+                    context.cash_callback, context.shares_callback,
+                    context.check_callback, context.execute_callback,
+                    contract.mu, **context.keywords)
+        self.p_vec = numpy.array(p_vec)
+        values = 100.0 * self.p_vec[-1]
+        self.user_list = []
+        for contract, log, population, start, end in groups:
+            self.user_list.extend(population.all_users(
+                    lambda trader:(trader[0].name, trader[1])))
+        self.liquidation = book.liquidation(values)
+        self.market_profits = book.profits(values)
+        self.market_maker_user = book.user_account
+
+    def profits_by_user(self):
+        """Like Simulation.profits_by_user, the market maker's profit is
+        the sum over the markets, see market_profits for each."""
+        assert self.user_list is not None
+        ret = {self.book_fact.name:self.market_profits.sum()}
+        for trader_name, user in self.user_list:
+            ret[trader_name] = ret.get(trader_name, 0.0) + user.profit(
+                self.liquidation)
+        return ret
@@ -0,0 +1,159 @@
+import estimators
+import hashlib
+import inspect
+import itertools
+import json
+import multiprocessing
+import my_bot
+import os
+import other_bots
+import prices
+import run_experiments
+import sys
+
+# A config is a dict with these keys, missing keys take these values.
+# my_bot holds keyword arguments for MyBot.
+DEFAULTS = {'lmsr_b':150, 'timesteps':100, 'simulations':2000,
+            'num_fundamentals':8, 'num_technical':2, 'my_bot':{}}
+# modules whose code changes every result
+CORE_MODULES = ['estimators', 'information', 'marketmaker', 'prices',
+                'run_experiments', 'simulation', 'traders']
+
+def grid(**axes):
+    """Every combination of the axes' values as a list of configs, e.g.
+    grid(lmsr_b=[150, 250], my_bot=[{}, {'window_length':30}])."""
+    names = sorted(axes)
+    return [dict(zip(names, values))
+            for values in itertools.product(*[axes[name] for name in names])]
+
+def default_traders(config):
+    bots = [my_bot.MyBot(**config['my_bot'])]
+    bots.extend(other_bots.get_bots(config['num_fundamentals'],
+                                    config['num_technical']))
+    return bots
+
+def code_version(trader_specs):
+    """Hash of the source of the simulation and the traders' modules."""
+    digest = hashlib.sha1()
+    modules = set(CORE_MODULES) | set(spec[0] for spec in trader_specs)
+    for name in sorted(modules):
+        __import__(name)
+        with open(inspect.getsourcefile(sys.modules[name])) as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+def cell_key(config, trader_specs):
+    return hashlib.sha1(json.dumps(
+            [config, trader_specs, code_version(trader_specs)],
+            sort_keys=True)).hexdigest()
+
+def load_cell(cache_dir, key):
+    path = os.path.join(cache_dir, key + '.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as cached:
+        stats = json.load(cached)['stats']
+    return dict((name, estimators.RunningStats.from_dict(values))
+                for name, values in stats.iteritems())
+
+def save_cell(cache_dir, key, config, stats):
+    path = os.path.join(cache_dir, key + '.json')
+    with open(path + '.tmp', 'w') as cached:
+        json.dump({'config':config,
+                   'stats':dict((name, values.as_dict())
+                                for name, values in stats.iteritems())},
+                  cached, sort_keys=True)
+    # the rename is atomic, an interrupted write leaves no cache entry
+    os.rename(path + '.tmp', path)
+
+def sweep_worker_process(args):
+    cell, spec = args
+    return (cell,) + run_experiments.worker_process(spec)
+
+def sweep(configs, cache_dir='sweep_cache', make_traders=default_traders,
+          num_processes=2, seed=0, chunksize=20):
+    """Run every config (see DEFAULTS and grid) on one shared pool,
+    most expensive first. The traders are built and given their params
+    first, so a bad knob raises before anything runs. Each finished
+    config whose simulations all succeeded is saved in cache_dir under
+    a hash of the config, the traders, the code version and the seed,
+    so an interrupted sweep resumes where it stopped and repeated
+    configs come back at once. All configs use the same seed, so their
+    simulations share information paths. Returns, in the order of
+    configs, {name: RunningStats} with the market maker's profit under
+    the name 'market_maker'."""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    keys = []
+    cells = {}
+    for config in configs:
+        full_config = dict(DEFAULTS, seed=seed)
+        full_config.update(config)
+        trader_specs = tuple(run_experiments.trader_spec(trader)
+                             for trader in make_traders(full_config))
+        run_experiments.check_trader_specs(trader_specs,
+                                           full_config['timesteps'])
+        key = cell_key(full_config, trader_specs)
+        keys.append(key)
+        if key not in cells:
+            cells[key] = {'config':full_config,
+                          'trader_specs':trader_specs,
+                          'stats':load_cell(cache_dir, key)}
+    todo = [cell for cell in cells if cells[cell]['stats'] is None]
+    todo.sort(key=lambda key: cells[key]['config']['simulations']
+              * cells[key]['config']['timesteps']
+              * len(cells[key]['trader_specs']), reverse=True)
+    print '%d configs, %d cached, %d to run' % (
+        len(cells), len(cells) - len(todo), len(todo))
+
+    def specs():
+        for key in todo:
+            config = cells[key]['config']
+            for spec in run_experiments.simulation_specs(
+                    config['simulations'], config['timesteps'],
+                    prices.LMSRFactory(config['lmsr_b']),
+                    cells[key]['trader_specs'], config['seed']):
+                yield key, spec
+
+    running = {}
+    for key in todo:
+        columns = run_experiments.profit_columns(
+            'market_maker', cells[key]['trader_specs'])
+        running[key] = {
+            'columns':columns,
+            'stats':run_experiments.new_stats(columns),
+            'remaining':cells[key]['config']['simulations'],
+            'failed':0}
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        for key, index, market_profit, trader_profits, totals in (
+                pool.imap_unordered(sweep_worker_process, specs(),
+                                    chunksize)):
+            cell = running[key]
+            cell['remaining'] -= 1
+            if market_profit is None:
+                cell['failed'] += 1
+            else:
+                run_experiments.fold_profits(cell['stats'], cell['columns'],
+                                             market_profit, trader_profits)
+            if cell['remaining'] == 0:
+                config = json.dumps(cells[key]['config'], sort_keys=True)
+                # only complete cells are cached, a rerun retries the rest
+                if cell['failed']:
+                    print >> sys.stderr, ('%s: %d simulations failed, '
+                                          'not cached') % (config,
+                                                           cell['failed'])
+                else:
+                    save_cell(cache_dir, key, cells[key]['config'],
+                              cell['stats'])
+                cells[key]['stats'] = cell['stats']
+                del running[key]
+                print 'done %s: %s' % (
+                    config,
+                    ', '.join('%s %1.2f' % (name, stats.mean)
+                              for name, stats in sorted(
+                                  cell['stats'].iteritems())))
+    finally:
+        pool.terminate()
+        pool.join()
+    return [cells[key]['stats'] for key in keys]
@@ -1,8 +1,16 @@
 import abc
+import collections
+import inspect
+import profiling
 import random
 
 class Trader(object):
     name = 'generic'
+    def __init__(self, **params):
+        # keyword arguments for simulation_params, so a trader can be
+        # rebuilt from its class and params
+        self.params = params
+
     def simulation_params(self, timesteps,
                           possible_jump_locations,
                           single_jump_probability):
@@ -14,23 +22,125 @@ class Trader(object):
     def trades_history(self, trades, time):
         pass
 
+    def new_trades(self, trades, time):
+        pass
+
     @abc.abstractmethod
     def trading_opportunity(self, cash_callback, shares_callback,
-                            check_callback, execute_callback, mu):
+                            check_callback, execute_callback, mu,
+                            quantity_callback=None,
+                            check_many_callback=None):
+        # quantity_callback and check_many_callback are only passed to
+        # traders whose trading_opportunity names them, see
+        # optional_callbacks
         pass
 
+OPTIONAL_CALLBACKS = ('quantity_callback', 'check_many_callback')
+
+def optional_callbacks(trader):
+    '''The OPTIONAL_CALLBACKS the trader's trading_opportunity accepts.
+    Traders written to the original five argument interface get none.'''
+    args, varargs, keywords, defaults = inspect.getargspec(
+        trader.trading_opportunity)
+    if keywords is not None:
+        return OPTIONAL_CALLBACKS
+    return tuple(name for name in OPTIONAL_CALLBACKS if name in args)
+
+def search_quantity(check_callback, buysell, price, limit):
+    '''Largest whole quantity up to limit whose check_callback price is
+    at most (buy) or at least (sell) price, by bisection. Stands in for
+    quantity_callback when a trader is not given one.'''
+    if buysell == 'buy':
+        within = lambda quantity: check_callback(buysell, quantity) <= price
+    else:
+        within = lambda quantity: check_callback(buysell, quantity) >= price
+    low, high = 0, int(limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if within(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+class TradeFeed(object):
+    '''Cursor over the append-only list of executions.'''
+    def __init__(self, trades):
+        self.trades = trades
+        self.position = 0
+
+    def read(self):
+        '''Executions appended since the previous read.'''
+        new_trades = self.trades[self.position:]
+        self.position = len(self.trades)
+        return new_trades
+
+class RollingWindow(object):
+    '''Sum, mean, min and max of the last `length` values pushed, each
+    in amortized O(1).'''
+    def __init__(self, length):
+        self.length = length
+        self.values = collections.deque()
+        self.total = 0.0
+        self.count = 0
+        # (index, value) pairs with increasing values for min and
+        # decreasing values for max
+        self._min = collections.deque()
+        self._max = collections.deque()
+
+    def push(self, value):
+        self.values.append(value)
+        self.total += value
+        if len(self.values) > self.length:
+            self.total -= self.values.popleft()
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((self.count, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((self.count, value))
+        self.count += 1
+        oldest = self.count - self.length
+        if self._min[0][0] < oldest:
+            self._min.popleft()
+        if self._max[0][0] < oldest:
+            self._max.popleft()
+
+    def __len__(self):
+        return len(self.values)
+
+    def full(self):
+        return len(self.values) == self.length
+
+    def sum(self):
+        return self.total
+
+    def mean(self):
+        return self.total / float(len(self.values))
+
+    def min(self):
+        return self._min[0][1]
+
+    def max(self):
+        return self._max[0][1]
+
 class TradingPopulation(object):
     def __init__(self, timesteps, possible_jump_locations,
                  single_jump_probability, traders,
-                 user_callback=lambda trader, i:None):
+                 user_callback=lambda trader, i:None, rng=None,
+                 profiler=None):
         self.timesteps = timesteps
+        self.profiler = profiler
+        self.rng = random if rng is None else rng
         self.possible_jump_locations = possible_jump_locations
         self.single_jump_probability = single_jump_probability
         self.active_traders = []
         self.populations = {}
+        self.trade_feed = None
         for i, trader in enumerate(traders):
             trader.simulation_params(timesteps, possible_jump_locations,
-                                     single_jump_probability)
+                                     single_jump_probability,
+                                     **getattr(trader, 'params', {}))
             trader_tuple = (trader, user_callback(trader, i))
             self.populations.setdefault(
                 trader.name, []).append(trader_tuple)
@@ -38,15 +148,49 @@ class TradingPopulation(object):
 
     def new_information(self, get_info_callback, execution_prices,
                         round_number):
+        if (self.trade_feed is None
+            or self.trade_feed.trades is not execution_prices):
+            self.trade_feed = TradeFeed(execution_prices)
+        new_trades = self.trade_feed.read()
+        if self.profiler is not None:
+            self.profiled_new_information(get_info_callback,
+                                          execution_prices, new_trades,
+                                          round_number)
+            return
+        for trader_type, traders in self.populations.iteritems():
+            for trader in traders:
+                trader[0].trades_history(
+                    execution_prices, round_number)
+                trader[0].new_trades(new_trades, round_number)
+                trader[0].new_information(
+                    get_info_callback(), round_number)
+
+    def profiled_new_information(self, get_info_callback, execution_prices,
+                                 new_trades, round_number):
+        clock = profiling.clock
         for trader_type, traders in self.populations.iteritems():
             for trader in traders:
+                start = clock()
                 trader[0].trades_history(
                     execution_prices, round_number)
+                trader[0].new_trades(new_trades, round_number)
+                middle = clock()
                 trader[0].new_information(
                     get_info_callback(), round_number)
+                end = clock()
+                self.profiler.add(trader_type, 'trades_history',
+                                  middle - start)
+                self.profiler.add(trader_type, 'new_information',
+                                  end - middle)
+
+    def information_order(self):
+        '''(trader, user) pairs in the order new_information hands out
+        the draws.'''
+        return [trader for trader_type, traders
+                in self.populations.iteritems() for trader in traders]
 
     def get_traders(self):
-        random.shuffle(self.active_traders)
+        self.rng.shuffle(self.active_traders)
         return self.active_traders
 
     def all_users(self, key):